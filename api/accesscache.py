@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import namedtuple
+
+from drfx import config
+
+# user_id is None when no user has the credential
+AccessDecision = namedtuple("AccessDecision", ["user_id", "granted", "data", "expires"])
+
+
+class AccessCache:
+    """
+    Process local cache of door access decisions
+
+    Maps (method, credential) to the user id, the access verdict and the user
+    data returned to the device. Normalize phone numbers before using them.
+
+    The whole cache is cleared when users, NFC cards or service subscriptions
+    change in this process, see api/signals.py. Changes made by other
+    processes, like the daily jobs, are seen after ACCESS_CACHE_TIMEOUT seconds.
+    """
+
+    _decisions = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(method, credential):
+        decision = AccessCache._decisions.get((method, credential))
+        if decision is None or decision.expires < time.monotonic():
+            return None
+        return decision
+
+    @staticmethod
+    def set(method, credential, user_id, granted, data):
+        decision = AccessDecision(
+            user_id, granted, data, time.monotonic() + config.ACCESS_CACHE_TIMEOUT
+        )
+        with AccessCache._lock:
+            AccessCache._decisions[(method, credential)] = decision
+        return decision
+
+    @staticmethod
+    def clear():
+        with AccessCache._lock:
+            AccessCache._decisions = {}
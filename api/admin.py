@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import AccessDevice, DeviceAccessLogEntry
+from .models import AccessDevice, AccessGrant, DeviceAccessLogEntry
 
 
 class AccessDeviceAdmin(admin.ModelAdmin):
@@ -20,5 +20,18 @@ class DeviceAccessLogEntryAdmin(admin.ModelAdmin):
     ]
 
 
+class AccessGrantAdmin(admin.ModelAdmin):
+    list_display = [
+        "method",
+        "credential",
+        "user",
+        "granted",
+        "last_modified",
+    ]
+    list_filter = ["method", "granted"]
+    search_fields = ["credential"]
+
+
 admin.site.register(AccessDevice, AccessDeviceAdmin)
+admin.site.register(AccessGrant, AccessGrantAdmin)
 admin.site.register(DeviceAccessLogEntry, DeviceAccessLogEntryAdmin)
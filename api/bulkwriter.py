@@ -0,0 +1,103 @@
+import atexit
+import logging
+import threading
+import weakref
+
+from django.db import IntegrityError, close_old_connections
+
+from drfx import config
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter:
+    """
+    Saves model instances in the background with bulk_create
+
+    Instances are queued in memory and written by a background thread every
+    ACCESS_LOG_FLUSH_INTERVAL seconds, or sooner when ACCESS_LOG_FLUSH_SIZE
+    instances are waiting, so the request does not wait for the insert. What is
+    left in the queue is written when the process exits and by the gunicorn
+    worker_exit and worker_abort hooks, see drfx/gunicorn.py. A process killed
+    with SIGKILL loses the instances of the last ACCESS_LOG_FLUSH_INTERVAL
+    seconds. If writing fails the
+    instances are kept for the next try, except the ones that can never be
+    written because of integrity errors.
+
+    With ACCESS_LOG_FLUSH_INTERVAL of 0 the instances are saved right away.
+    """
+
+    # how many instances are kept when the database can not be written
+    MAX_QUEUED = 10000
+
+    # every writer of the process, for flush_all
+    _writers = weakref.WeakSet()
+
+    def __init__(self, model):
+        self.model = model
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        BulkWriter._writers.add(self)
+
+    @staticmethod
+    def flush_all():
+        """
+        Write what is queued in all the writers, called when the worker exits
+        """
+        for writer in list(BulkWriter._writers):
+            writer.flush()
+
+    def add(self, instance):
+        if not config.ACCESS_LOG_FLUSH_INTERVAL:
+            instance.save()
+            return
+
+        with self.lock:
+            self.queue.append(instance)
+            queued = len(self.queue)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=f"{self.model.__name__} writer", daemon=True
+                )
+                self.thread.start()
+                atexit.register(self.flush)
+        if queued >= config.ACCESS_LOG_FLUSH_SIZE:
+            self.wakeup.set()
+
+    def flush(self):
+        """
+        Write everything that is queued
+        """
+        with self.lock:
+            instances, self.queue = self.queue, []
+        if not instances:
+            return
+        try:
+            self.model.objects.bulk_create(instances)
+        except IntegrityError:
+            # for example a device deleted in another process, write the rest
+            for index, instance in enumerate(instances):
+                try:
+                    instance.save()
+                except IntegrityError as e:
+                    logger.error(f"Dropped {self.model.__name__} {instance}: {e}")
+                except Exception as e:
+                    self._requeue(instances[index:], e)
+                    return
+        except Exception as e:
+            self._requeue(instances, e)
+
+    def _requeue(self, instances, error):
+        logger.error(f"Writing {len(instances)} {self.model.__name__}: {error}")
+        limit = self.MAX_QUEUED
+        with self.lock:
+            self.queue = (instances + self.queue)[-limit:]
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(config.ACCESS_LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            close_old_connections()
+            self.flush()
@@ -0,0 +1,22 @@
+from django.core import checks
+
+from drfx import config
+
+
+@checks.register()
+def check_access_api_log_policy(app_configs, **kwargs):
+    """
+    ACCESS_API_LOG_POLICY must be one of the known policies
+    """
+    from api.views import AccessLoggingMixin
+
+    policy = config.ACCESS_API_LOG_POLICY
+    if policy in AccessLoggingMixin.LOG_POLICIES:
+        return []
+    return [
+        checks.Error(
+            f"Unknown ACCESS_API_LOG_POLICY {policy!r}",
+            hint=f"Use one of {', '.join(AccessLoggingMixin.LOG_POLICIES)}",
+            id="api.E001",
+        )
+    ]
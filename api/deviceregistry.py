@@ -0,0 +1,87 @@
+import threading
+import time
+from itertools import islice
+
+from drfx import config
+
+from .models import AccessDevice
+
+
+class DeviceRegistry:
+    """
+    Process local registry of the access devices by deviceid
+
+    All the devices are loaded at once and reloaded after ACCESS_DEVICE_CACHE_TIMEOUT
+    seconds or when a device is saved or deleted in this process, see api/signals.py.
+    Unknown device ids are remembered for ACCESS_DEVICE_UNKNOWN_TIMEOUT seconds so
+    that a misconfigured device does not cause a database lookup on every request.
+    At most MAX_UNKNOWN of them are remembered, the expired and then the oldest
+    ones are forgotten first.
+    """
+
+    # how many unknown device ids are remembered
+    MAX_UNKNOWN = 1000
+
+    _devices = {}
+    _expires = 0
+    _unknown = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(deviceid):
+        """
+        Returns the device or None if there is no such device
+        """
+        now = time.monotonic()
+        if DeviceRegistry._expires < now:
+            DeviceRegistry._load(now)
+
+        device = DeviceRegistry._devices.get(deviceid)
+        if device is not None:
+            return device
+        if DeviceRegistry._unknown.get(deviceid, 0) > now:
+            return None
+
+        # could have been added by another process
+        device = AccessDevice.objects.filter(deviceid=deviceid).first()
+        with DeviceRegistry._lock:
+            if device is None:
+                DeviceRegistry._remember_unknown(deviceid, now)
+            else:
+                DeviceRegistry._devices = {
+                    **DeviceRegistry._devices,
+                    deviceid: device,
+                }
+        return device
+
+    @staticmethod
+    def _remember_unknown(deviceid, now):
+        """
+        Called with the lock held
+        """
+        unknown = DeviceRegistry._unknown
+        unknown.pop(deviceid, None)
+        limit = DeviceRegistry.MAX_UNKNOWN
+        if len(unknown) >= limit:
+            unknown = {
+                key: expires for key, expires in unknown.items() if expires > now
+            }
+            # the ids are in the order they expire
+            unknown = dict(
+                islice(unknown.items(), max(len(unknown) - limit + 1, 0), None)
+            )
+            DeviceRegistry._unknown = unknown
+        unknown[deviceid] = now + config.ACCESS_DEVICE_UNKNOWN_TIMEOUT
+
+    @staticmethod
+    def clear():
+        with DeviceRegistry._lock:
+            DeviceRegistry._expires = 0
+
+    @staticmethod
+    def _load(now):
+        devices = {device.deviceid: device for device in AccessDevice.objects.all()}
+        with DeviceRegistry._lock:
+            DeviceRegistry._devices = devices
+            DeviceRegistry._unknown = {}
+            DeviceRegistry._expires = now + config.ACCESS_DEVICE_CACHE_TIMEOUT
@@ -0,0 +1,270 @@
+import json
+import random
+import statistics
+import time
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_tracking.models import APIRequestLog
+
+from api.accesscache import AccessCache
+from api.models import AccessDevice, AccessGrant, DeviceAccessLogEntry
+from api.views import access_log_writer, api_log_writer
+from drfx import config
+from users.models import CustomUser, MemberService, NFCCard, ServiceSubscription
+
+METHODS = ["phone", "nfc", "mxid"]
+# markers of the synthetic rows for the cleanup
+HOST = "benchmark.invalid"
+MUNICIPALITY = "Benchmark"
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the latency of the door access api with synthetic users and log rows. "
+        "The rows are written to the configured database and removed afterwards, "
+        "so this runs only with DEBUG on"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument(
+            "--log-rows",
+            type=int,
+            default=100000,
+            help="How many door access and api request log rows are added",
+        )
+        parser.add_argument(
+            "--requests", type=int, default=200, help="Requests per method"
+        )
+        parser.add_argument(
+            "--cold",
+            action="store_true",
+            help="Clear the access decision cache before every request",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        parser.add_argument(
+            "--output", help="Write the results to this file instead of stdout"
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError(
+                "The benchmark writes to the configured database, run it with DEBUG on against a development database"
+            )
+        if not MemberService.objects.filter(pk=config.DEFAULT_ACCOUNT_SERVICE).exists():
+            raise CommandError(
+                "DEFAULT_ACCOUNT_SERVICE does not exist, run initmemberservices first"
+            )
+        random.seed(options["seed"])
+
+        # every request commits on its own like in production and the log
+        # entries are written with the configured ACCESS_LOG_FLUSH_INTERVAL
+        with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + [HOST]), patch(
+            "api.views.VerySlowThrottle.allow_request", return_value=True
+        ):
+            try:
+                started = time.monotonic()
+                device, users = self.seed(options["users"], options["log_rows"])
+                seed_seconds = time.monotonic() - started
+
+                AccessCache.clear()
+                results = {
+                    method: self.measure(
+                        method, device, users, options["requests"], options["cold"]
+                    )
+                    for method in METHODS
+                }
+            finally:
+                access_log_writer.flush()
+                api_log_writer.flush()
+                self.cleanup()
+                AccessCache.clear()
+
+        report = {
+            "timestamp": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "options": {
+                key: options[key]
+                for key in ["users", "log_rows", "requests", "cold", "seed"]
+            },
+            "settings": {
+                "ACCESS_API_LOG_POLICY": config.ACCESS_API_LOG_POLICY,
+                "ACCESS_CACHE_TIMEOUT": config.ACCESS_CACHE_TIMEOUT,
+                "ACCESS_LOG_FLUSH_INTERVAL": config.ACCESS_LOG_FLUSH_INTERVAL,
+            },
+            "seed_seconds": round(seed_seconds, 3),
+            "results": results,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def seed(self, user_count, log_rows):
+        """
+        Create the device, the users with cards and subscriptions and the log rows
+
+        Three of four users have access, the rest have a suspended subscription.
+        The log rows are added in batches of 10000 so that no long transaction
+        blocks the door access of the real users.
+        """
+        device = AccessDevice.objects.create(
+            name="benchmark", deviceid=f"benchmark-{time.time_ns()}"
+        )
+        prefix = f"{random.randrange(10**6):06d}"
+        CustomUser.objects.bulk_create(
+            CustomUser(
+                email=f"benchmark{prefix}{i}@example.com",
+                first_name="Bench",
+                last_name=f"Mark{i}",
+                municipality=MUNICIPALITY,
+                birthday=timezone.now().date(),
+                phone=f"+358{prefix}{i:07d}",
+                mxid=f"@benchmark{prefix}{i}:example.com",
+                is_active=True,
+            )
+            for i in range(user_count)
+        )
+        # not all databases return the ids from bulk_create
+        users = list(
+            CustomUser.objects.filter(
+                email__startswith=f"benchmark{prefix}", email__endswith="@example.com"
+            )
+        )
+        NFCCard.objects.bulk_create(
+            NFCCard(user=user, cardid=f"BENCHMARK{user.phone[1:]}") for user in users
+        )
+        ServiceSubscription.objects.bulk_create(
+            ServiceSubscription(
+                user=user,
+                service_id=config.DEFAULT_ACCOUNT_SERVICE,
+                state=(
+                    ServiceSubscription.SUSPENDED
+                    if index % 4 == 3
+                    else ServiceSubscription.ACTIVE
+                ),
+            )
+            for index, user in enumerate(users)
+        )
+        user_ids = [user.id for user in users]
+        for start in range(0, len(user_ids), 500):
+            end = start + 500
+            AccessGrant.objects.refresh_users(user_ids[start:end])
+        self.stderr.write(f"Created {len(users)} users")
+
+        now = timezone.now()
+        paths = [reverse(f"access-{method}") for method in METHODS]
+        for start in range(0, log_rows, 10000):
+            rows = range(start, min(start + 10000, log_rows))
+            DeviceAccessLogEntry.objects.bulk_create(
+                DeviceAccessLogEntry(
+                    device=device,
+                    date=now - timezone.timedelta(seconds=row * 30),
+                    granted=row % 4 != 3,
+                    method=METHODS[row % 3],
+                    payload=users[row % len(users)].phone if users else "",
+                )
+                for row in rows
+            )
+            APIRequestLog.objects.bulk_create(
+                APIRequestLog(
+                    requested_at=now - timezone.timedelta(seconds=row * 30),
+                    response_ms=10,
+                    path=paths[row % 3],
+                    host=HOST,
+                    method="POST",
+                    status_code=200,
+                )
+                for row in rows
+            )
+            self.stderr.write(f"Created {rows.stop} of {log_rows} log rows")
+        return device, users
+
+    def measure(self, method, device, users, requests, cold):
+        """
+        Post random credentials, one of ten unknown, and collect the timings
+        """
+        client = Client(HTTP_HOST=HOST)
+        url = reverse(f"access-{method}")
+        timings = []
+        queries = []
+        statuses = {}
+        for _ in range(requests):
+            user = random.choice(users) if users else None
+            if user is None or random.random() < 0.1:
+                payload = f"unknown{random.randrange(10**9)}"
+            elif method == "phone":
+                payload = user.phone
+            elif method == "nfc":
+                payload = f"BENCHMARK{user.phone[1:]}"
+            else:
+                payload = user.mxid
+            if cold:
+                AccessCache.clear()
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = client.post(
+                    url, {"deviceid": device.deviceid, "payload": payload}
+                )
+                timings.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured.captured_queries))
+            status = str(response.status_code)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        return {
+            "requests": requests,
+            "statuses": statuses,
+            "ms": Command.percentiles(timings),
+            "queries": Command.percentiles(queries),
+        }
+
+    def cleanup(self):
+        """
+        Remove the synthetic rows, also the ones left by a run that failed,
+        and the revoked grants of the synthetic users
+        """
+        users = CustomUser.objects.filter(
+            email__startswith="benchmark",
+            email__endswith="@example.com",
+            municipality=MUNICIPALITY,
+        )
+        credentials = list(
+            NFCCard.objects.filter(user__in=users).values_list("cardid", flat=True)
+        )
+        for phone, mxid in users.values_list("phone", "mxid"):
+            credentials += [phone, mxid]
+        users.delete()
+        for start in range(0, len(credentials), 500):
+            end = start + 500
+            AccessGrant.objects.filter(credential__in=credentials[start:end]).delete()
+        devices = AccessDevice.objects.filter(
+            name="benchmark", deviceid__startswith="benchmark-"
+        )
+        DeviceAccessLogEntry.objects.filter(device__in=devices).delete()
+        devices.delete()
+        APIRequestLog.objects.filter(host=HOST).delete()
+        self.stderr.write("Removed the synthetic rows")
+
+    @staticmethod
+    def percentiles(values):
+        if len(values) < 2:
+            return {}
+        # 99 cut points, index n-1 is the nth percentile
+        cuts = statistics.quantiles(values, n=100, method="inclusive")
+        return {
+            "mean": round(statistics.fmean(values), 3),
+            "p50": round(cuts[49], 3),
+            "p95": round(cuts[94], 3),
+            "p99": round(cuts[98], 3),
+            "max": round(max(values), 3),
+        }
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from drfx import config
+
+
+def create_access_grants(apps, schema_editor):
+    """
+    Same rules as AccessGrantManager.refresh_users
+    """
+    AccessGrant = apps.get_model("api", "AccessGrant")
+    CustomUser = apps.get_model("users", "CustomUser")
+    ServiceSubscription = apps.get_model("users", "ServiceSubscription")
+    active_users = set(
+        ServiceSubscription.objects.filter(
+            service=config.DEFAULT_ACCOUNT_SERVICE, state="ACTIVE"
+        ).values_list("user_id", flat=True)
+    )
+    grants = []
+    for user in CustomUser.objects.prefetch_related("nfccard_set"):
+        granted = user.is_active and user.id in active_users
+        credentials = [("phone", user.phone), ("mxid", user.mxid)] + [
+            ("nfc", card.cardid) for card in user.nfccard_set.all()
+        ]
+        for method, credential in credentials:
+            if credential:
+                grants.append(
+                    AccessGrant(
+                        method=method,
+                        credential=credential,
+                        user_id=user.id,
+                        granted=granted,
+                    )
+                )
+    AccessGrant.objects.bulk_create(grants, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_deviceaccesslogentry_method"),
+        ("users", "0030_alter_banktransaction_unique_together_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccessGrant",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "method",
+                    models.CharField(
+                        choices=[("phone", "phone"), ("nfc", "nfc"), ("mxid", "mxid")],
+                        max_length=64,
+                        verbose_name="Method",
+                    ),
+                ),
+                (
+                    "credential",
+                    models.CharField(
+                        max_length=255,
+                        verbose_name="NFC card id or phone number, or other field like that",
+                    ),
+                ),
+                (
+                    "granted",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Does the credential open the door",
+                        verbose_name="Granted",
+                    ),
+                ),
+                (
+                    "last_modified",
+                    models.DateTimeField(
+                        auto_now=True,
+                        help_text="Automatically updated",
+                        verbose_name="Last modified datetime",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        help_text="User that has this credential, empty if nobody has",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="User",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("method", "credential"), name="unique_access_grant"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(create_access_grants, migrations.RunPython.noop),
+    ]
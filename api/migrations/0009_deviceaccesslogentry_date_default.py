@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_accessgrant"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="deviceaccesslogentry",
+            name="date",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now,
+                editable=False,
+                help_text="Automatically set to now when created",
+                verbose_name="Date of this entry",
+            ),
+        ),
+    ]
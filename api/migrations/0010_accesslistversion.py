@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0009_deviceaccesslogentry_date_default"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccessListVersion",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="accessgrant",
+            name="version",
+            field=models.PositiveBigIntegerField(
+                db_index=True,
+                default=0,
+                help_text="Access list version where this was last changed",
+                verbose_name="Version",
+            ),
+        ),
+    ]
@@ -1,10 +1,13 @@
 import logging
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
 
-from users.models import NFCCard
+from drfx import config
+from users.models import CustomUser, NFCCard, ServiceSubscription
 
 logger = logging.getLogger(__name__)
 
@@ -45,8 +48,10 @@ class AccessDevice(models.Model):
 
 
 class DeviceAccessLogEntry(models.Model):
+    # not auto_now_add as the entries can be saved later, see BulkWriter
     date = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
+        editable=False,
         verbose_name=_("Date of this entry"),
         help_text=_("Automatically set to now when created"),
     )
@@ -92,3 +97,166 @@ class DeviceAccessLogEntry(models.Model):
         default="",
         max_length=64,
     )
+
+
+class AccessGrantManager(models.Manager):
+    def refresh_users(self, user_ids):
+        """
+        Update the grants of the credentials of the users from the users, their
+        NFC cards and their DEFAULT_ACCOUNT_SERVICE subscriptions
+
+        Same rules as CustomUser.has_door_access. Grants of credentials that
+        the users do not have anymore are revoked.
+        """
+        user_ids = set(user_ids)
+        active_users = set(
+            ServiceSubscription.objects.filter(
+                user_id__in=user_ids,
+                service=config.DEFAULT_ACCOUNT_SERVICE,
+                state=ServiceSubscription.ACTIVE,
+            ).values_list("user_id", flat=True)
+        )
+        wanted = {}
+        for user in CustomUser.objects.filter(id__in=user_ids).prefetch_related(
+            "nfccard_set"
+        ):
+            granted = user.is_active and user.id in active_users
+            credentials = [("phone", user.phone), ("mxid", user.mxid)] + [
+                ("nfc", card.cardid) for card in user.nfccard_set.all()
+            ]
+            for method, credential in credentials:
+                if credential:
+                    wanted[(method, credential)] = (user.id, granted)
+
+        with transaction.atomic():
+            existing = {
+                (grant.method, grant.credential): grant
+                for grant in self.filter(
+                    Q(user_id__in=user_ids)
+                    | Q(credential__in={credential for _, credential in wanted})
+                )
+            }
+            changed = []
+            for (method, credential), (user_id, granted) in wanted.items():
+                grant = existing.get((method, credential))
+                if grant is None:
+                    grant = AccessGrant(method=method, credential=credential)
+                elif grant.user_id == user_id and grant.granted == granted:
+                    continue
+                grant.user_id = user_id
+                grant.granted = granted
+                changed.append(grant)
+
+            if changed:
+                version = AccessListVersion.next()
+                for grant in changed:
+                    grant.version = version
+                    grant.save()
+
+            self.revoke(
+                self.filter(
+                    id__in=[
+                        grant.id
+                        for key, grant in existing.items()
+                        if grant.user_id in user_ids and key not in wanted
+                    ]
+                )
+            )
+
+    def revoke(self, grants):
+        """
+        Revoke the grants, the rows are kept for the credentials so that the
+        revocation can be sent to the door controllers
+        """
+        with transaction.atomic():
+            if grants.exists():
+                grants.update(
+                    user=None,
+                    granted=False,
+                    version=AccessListVersion.next(),
+                    last_modified=timezone.now(),
+                )
+
+
+class AccessListVersion(models.Model):
+    """
+    Version of the access list, one row that is increased on every change to AccessGrants
+    """
+
+    version = models.PositiveBigIntegerField(default=0)
+
+    @staticmethod
+    def current():
+        row = AccessListVersion.objects.filter(pk=1).first()
+        return row.version if row else 0
+
+    @staticmethod
+    def next():
+        """
+        Increase the version, call inside a transaction
+
+        The row stays locked until the transaction ends so the versions are
+        committed in order.
+        """
+        row, created = AccessListVersion.objects.select_for_update().get_or_create(pk=1)
+        row.version = models.F("version") + 1
+        row.save(update_fields=["version"])
+        row.refresh_from_db(fields=["version"])
+        return row.version
+
+
+class AccessGrant(models.Model):
+    """
+    Door access of one credential (phone number, NFC card id or Matrix ID)
+
+    Kept up to date from the users, NFC cards and service subscriptions by
+    api/signals.py so that an access check is one indexed lookup.
+    """
+
+    METHOD_CHOICES = [
+        ("phone", "phone"),
+        ("nfc", "nfc"),
+        ("mxid", "mxid"),
+    ]
+
+    method = models.CharField(
+        verbose_name=_("Method"),
+        choices=METHOD_CHOICES,
+        max_length=64,
+    )
+    credential = models.CharField(
+        verbose_name=_("NFC card id or phone number, or other field like that"),
+        max_length=255,
+    )
+    user = models.ForeignKey(
+        get_user_model(),
+        null=True,
+        verbose_name=_("User"),
+        help_text=_("User that has this credential, empty if nobody has"),
+        on_delete=models.SET_NULL,
+    )
+    granted = models.BooleanField(
+        default=False,
+        verbose_name=_("Granted"),
+        help_text=_("Does the credential open the door"),
+    )
+    version = models.PositiveBigIntegerField(
+        default=0,
+        db_index=True,
+        verbose_name=_("Version"),
+        help_text=_("Access list version where this was last changed"),
+    )
+    last_modified = models.DateTimeField(
+        auto_now=True,
+        verbose_name=_("Last modified datetime"),
+        help_text=_("Automatically updated"),
+    )
+
+    objects = AccessGrantManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["method", "credential"], name="unique_access_grant"
+            )
+        ]
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from users.models import CustomUser
 
+from .models import AccessGrant
+
 
 class AccessDataSerializer(serializers.Serializer):
     """
@@ -11,6 +13,25 @@ class AccessDataSerializer(serializers.Serializer):
     payload = serializers.CharField(max_length=200)
 
 
+class AccessBatchItemSerializer(serializers.Serializer):
+    """
+    Serializer for one access attempt in a batch
+    """
+
+    method = serializers.ChoiceField(choices=["phone", "nfc", "mxid"])
+    payload = serializers.CharField(max_length=200)
+    timestamp = serializers.DateTimeField()
+
+
+class AccessBatchSerializer(serializers.Serializer):
+    """
+    Serializer for incoming batch of access attempts from one device
+    """
+
+    deviceid = serializers.CharField(max_length=200)
+    items = AccessBatchItemSerializer(many=True, allow_empty=False, max_length=1000)
+
+
 class UserAccessSerializer(serializers.HyperlinkedModelSerializer):
     """
     Serializer for user access data return
@@ -26,3 +47,32 @@ class UserAccessSerializer(serializers.HyperlinkedModelSerializer):
             "phone",
         )
         read_only_fields = ("is_active",)
+
+
+class AccessGrantSerializer(serializers.ModelSerializer):
+    """
+    Serializer for granted credentials in the access list
+    """
+
+    user = UserAccessSerializer(read_only=True)
+
+    class Meta:
+        model = AccessGrant
+        fields = (
+            "method",
+            "credential",
+            "user",
+        )
+
+
+class RevokedAccessSerializer(serializers.ModelSerializer):
+    """
+    Serializer for revoked credentials in the access list
+    """
+
+    class Meta:
+        model = AccessGrant
+        fields = (
+            "method",
+            "credential",
+        )
@@ -0,0 +1,79 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from users.models import CustomUser, NFCCard, ServiceSubscription
+from users.signals import activate_user, deactivate_user, subscriptions_changed
+
+from .accesscache import AccessCache
+from .deviceregistry import DeviceRegistry
+from .models import AccessDevice, AccessGrant
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+@receiver(post_save, sender=NFCCard)
+@receiver(post_delete, sender=NFCCard)
+@receiver(post_save, sender=ServiceSubscription)
+@receiver(post_delete, sender=ServiceSubscription)
+@receiver(subscriptions_changed)
+@receiver(activate_user)
+@receiver(deactivate_user)
+def access_changed(sender, **kwargs):
+    """
+    Anything that can change the door access of someone clears the cached decisions
+
+    Cleared again after commit so that a request in between does not cache the old state
+    """
+    AccessCache.clear()
+    transaction.on_commit(AccessCache.clear)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_access_grants(sender, instance: CustomUser, raw, **kwargs):
+    """
+    Activation and changed phone number or mxid
+    """
+    if raw:
+        return
+    AccessGrant.objects.refresh_users([instance.id])
+
+
+@receiver(pre_delete, sender=CustomUser)
+def deleted_user_access_grants(sender, instance: CustomUser, **kwargs):
+    AccessGrant.objects.revoke(AccessGrant.objects.filter(user=instance))
+
+
+@receiver(post_save, sender=NFCCard)
+@receiver(post_save, sender=ServiceSubscription)
+def access_grants(sender, instance, raw=False, **kwargs):
+    """
+    Card changes and subscription state changes
+    """
+    if raw:
+        return
+    AccessGrant.objects.refresh_users([instance.user_id])
+
+
+@receiver(post_delete, sender=NFCCard)
+@receiver(post_delete, sender=ServiceSubscription)
+def deleted_access_grants(sender, instance, origin=None, **kwargs):
+    # the user is being deleted, deleted_user_access_grants handles it
+    # origin is the deleted instance or queryset
+    if isinstance(origin, CustomUser) or getattr(origin, "model", None) is CustomUser:
+        return
+    AccessGrant.objects.refresh_users([instance.user_id])
+
+
+@receiver(subscriptions_changed)
+def bulk_access_grants(sender, subscriptions, **kwargs):
+    AccessGrant.objects.refresh_users(
+        {subscription.user_id for subscription in subscriptions}
+    )
+
+
+@receiver(post_save, sender=AccessDevice)
+@receiver(post_delete, sender=AccessDevice)
+def access_device_changed(sender, **kwargs):
+    DeviceRegistry.clear()
+    transaction.on_commit(DeviceRegistry.clear)
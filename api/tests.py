@@ -1,21 +1,52 @@
+import json
+import time
+import threading
+from io import StringIO
 from unittest.mock import patch
 
 from django.core import mail
+from django.core.management import CommandError, call_command
 from django.urls import reverse
 from django.utils import timezone
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from django.http import HttpRequest
 
-from api.models import AccessDevice
+from api import views
+from api.bulkwriter import BulkWriter
+from api.checks import check_access_api_log_policy
+from api.deviceregistry import DeviceRegistry
+from api.models import (
+    AccessDevice,
+    AccessGrant,
+    AccessListVersion,
+    DeviceAccessLogEntry,
+)
 from drfx import config
+from drfx.gunicorn import worker_exit
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 from rest_framework_tracking.models import APIRequestLog
-from users.models import CustomUser, MemberService, NFCCard, ServiceSubscription
+from users.models import (
+    CustomUser,
+    MemberService,
+    NFCCard,
+    ServiceSubscription,
+    UsersLog,
+)
+from users.signals import (
+    DOOR_ACCESS_DENIED,
+    DOOR_ACCESS_DENIED_NOTIFIED,
+    subscriptions_changed,
+)
+from utils.businesslogic import BusinessLogic
 from api.mulysaoauthvalidator import MulysaOAuth2Validator
+from api.views import AccessLoggingMixin, access_log_writer, api_log_writer
 from django.contrib.sites.models import Site
+from mailer.models import Message
+
 
 class TestOAuthValidator(APITestCase):
     def setUp(self):
@@ -45,6 +76,117 @@ class TestOAuthValidator(APITestCase):
         CustomUser.objects.all().delete()
 
 
+class TestBulkWriter(APITestCase):
+    def setUp(self):
+        self.device = AccessDevice.objects.create(deviceid="testdevice")
+
+    @override_settings(ACCESS_LOG_FLUSH_INTERVAL=3600, ACCESS_LOG_FLUSH_SIZE=1000)
+    def test_entries_written_on_flush(self):
+        writer = BulkWriter(DeviceAccessLogEntry)
+        entries = [
+            DeviceAccessLogEntry(device=self.device, payload=str(i), granted=True)
+            for i in range(3)
+        ]
+        for entry in entries:
+            writer.add(entry)
+        self.assertEqual(DeviceAccessLogEntry.objects.count(), 0)
+
+        with self.assertNumQueries(1):
+            writer.flush()
+        self.assertEqual(DeviceAccessLogEntry.objects.count(), 3)
+        # the date is when the entry was made, not when it was written
+        self.assertEqual(
+            DeviceAccessLogEntry.objects.get(payload="0").date, entries[0].date
+        )
+
+    @override_settings(ACCESS_LOG_FLUSH_INTERVAL=3600, ACCESS_LOG_FLUSH_SIZE=1000)
+    def test_flush_all(self):
+        writers = [BulkWriter(DeviceAccessLogEntry) for _ in range(2)]
+        for writer in writers:
+            writer.add(DeviceAccessLogEntry(device=self.device, granted=True))
+        self.assertEqual(DeviceAccessLogEntry.objects.count(), 0)
+
+        # as the gunicorn hooks do when the worker exits
+        worker_exit(None, None)
+        self.assertEqual(DeviceAccessLogEntry.objects.count(), 2)
+
+    def test_unbuffered(self):
+        writer = BulkWriter(DeviceAccessLogEntry)
+        writer.add(DeviceAccessLogEntry(device=self.device, granted=False))
+        self.assertEqual(DeviceAccessLogEntry.objects.count(), 1)
+        self.assertIsNone(writer.thread)
+
+
+class TestDeviceRegistry(APITestCase):
+    def setUp(self):
+        self.device = AccessDevice.objects.create(deviceid="testdevice")
+
+    def test_devices_cached(self):
+        self.assertEqual(DeviceRegistry.get("testdevice"), self.device)
+        with self.assertNumQueries(0):
+            self.assertEqual(DeviceRegistry.get("testdevice"), self.device)
+
+        # unknown device is looked up once
+        self.assertIsNone(DeviceRegistry.get("unknown"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(DeviceRegistry.get("unknown"))
+
+        # changes are noticed
+        device = AccessDevice.objects.create(deviceid="unknown")
+        self.assertEqual(DeviceRegistry.get("unknown"), device)
+        self.device.delete()
+        self.assertIsNone(DeviceRegistry.get("testdevice"))
+
+    def test_unknown_limited(self):
+        DeviceRegistry.clear()
+        with patch.object(DeviceRegistry, "MAX_UNKNOWN", 3):
+            for i in range(5):
+                self.assertIsNone(DeviceRegistry.get(f"unknown{i}"))
+            self.assertEqual(
+                list(DeviceRegistry._unknown), ["unknown2", "unknown3", "unknown4"]
+            )
+            with self.assertNumQueries(0):
+                self.assertIsNone(DeviceRegistry.get("unknown4"))
+            # the oldest is looked up again
+            with self.assertNumQueries(1):
+                self.assertIsNone(DeviceRegistry.get("unknown0"))
+            self.assertEqual(len(DeviceRegistry._unknown), 3)
+
+
+class TestBenchmarkAccess(APITestCase):
+    fixtures = ["users/fixtures/memberservices.json"]
+
+    @override_settings(DEBUG=True)
+    def test_benchmark(self):
+        out = StringIO()
+        call_command(
+            "benchmark_access",
+            users=8,
+            log_rows=20,
+            requests=10,
+            stdout=out,
+            stderr=StringIO(),
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report["results"]), {"phone", "nfc", "mxid"})
+        for result in report["results"].values():
+            self.assertEqual(sum(result["statuses"].values()), 10)
+            self.assertLessEqual(result["ms"]["p50"], result["ms"]["p99"])
+            self.assertGreater(result["queries"]["max"], 0)
+
+        # the synthetic data is removed
+        self.assertFalse(CustomUser.objects.exists())
+        self.assertFalse(AccessDevice.objects.exists())
+        self.assertFalse(AccessGrant.objects.exists())
+        self.assertFalse(DeviceAccessLogEntry.objects.exists())
+        self.assertFalse(APIRequestLog.objects.exists())
+
+    def test_benchmark_needs_debug(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark_access", users=1, log_rows=1, requests=2)
+        self.assertFalse(CustomUser.objects.exists())
+
+
 @patch("api.views.VerySlowThrottle.allow_request", return_value=True)
 class TestLogging(APITestCase):
     fixtures = ["users/fixtures/memberservices.json"]
@@ -74,6 +216,91 @@ class TestLogging(APITestCase):
         self.assertIn(self.ok_user.phone, APIRequestLog.objects.first().data)
         self.assertIn(self.ok_user.email, APIRequestLog.objects.first().response)
 
+    def _access(self):
+        url = reverse("access-phone")
+        data = {"deviceid": self.device.deviceid, "payload": self.ok_user.phone}
+        return self.client.post(url, data)
+
+    @override_settings(ACCESS_API_LOG_POLICY="errors")
+    def test_errors_only(self, mock):
+        # denied access is always logged
+        self.assertEqual(self._access().status_code, 481)
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+
+        ServiceSubscription.objects.create(
+            user=self.ok_user,
+            service=MemberService.objects.get(pk=config.DEFAULT_ACCOUNT_SERVICE),
+            state=ServiceSubscription.ACTIVE,
+        )
+        self.assertEqual(self._access().status_code, 200)
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+
+    @override_settings(ACCESS_API_LOG_POLICY="errors")
+    def test_errors_only_batch(self, mock):
+        ServiceSubscription.objects.create(
+            user=self.ok_user,
+            service=MemberService.objects.get(pk=config.DEFAULT_ACCOUNT_SERVICE),
+            state=ServiceSubscription.ACTIVE,
+        )
+        url = reverse("access-batch")
+        item = {
+            "method": "phone",
+            "payload": self.ok_user.phone,
+            "timestamp": timezone.now().isoformat(),
+        }
+        data = {"deviceid": self.device.deviceid, "items": [item]}
+        self.assertEqual(self.client.post(url, data, format="json").status_code, 200)
+        self.assertEqual(APIRequestLog.objects.count(), 0)
+
+        # a denied item is logged although the batch itself is fine
+        data["items"].append(dict(item, payload="+358000000000"))
+        response = self.client.post(url, data, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]], [0, 480]
+        )
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+
+    @override_settings(ACCESS_API_LOG_POLICY="error")
+    def test_unknown_policy(self, mock):
+        # reported by the system checks
+        errors = check_access_api_log_policy(None)
+        self.assertEqual([error.id for error in errors], ["api.E001"])
+
+        # but the door keeps working and the requests are logged like with full
+        self.assertEqual(AccessLoggingMixin.log_policy(), "full")
+        self.assertEqual(self._access().status_code, 481)
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+
+    def test_known_policy(self, mock):
+        self.assertEqual(check_access_api_log_policy(None), [])
+
+    @override_settings(ACCESS_API_LOG_POLICY="sampled", ACCESS_API_LOG_SAMPLE_RATE=0)
+    def test_sampled(self, mock):
+        ServiceSubscription.objects.create(
+            user=self.ok_user,
+            service=MemberService.objects.get(pk=config.DEFAULT_ACCOUNT_SERVICE),
+            state=ServiceSubscription.ACTIVE,
+        )
+        self.assertEqual(self._access().status_code, 200)
+        self.assertEqual(APIRequestLog.objects.count(), 0)
+        with override_settings(ACCESS_API_LOG_SAMPLE_RATE=1):
+            self._access()
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+
+    @override_settings(
+        ACCESS_API_LOG_POLICY="deferred",
+        ACCESS_LOG_FLUSH_INTERVAL=3600,
+        ACCESS_LOG_FLUSH_SIZE=1000,
+    )
+    def test_deferred(self, mock):
+        self.assertEqual(self._access().status_code, 481)
+        self.assertEqual(APIRequestLog.objects.count(), 0)
+        api_log_writer.flush()
+        access_log_writer.flush()
+        self.assertEqual(APIRequestLog.objects.count(), 1)
+        self.assertIn(self.ok_user.phone, APIRequestLog.objects.first().data)
+
     def tearDown(self):
         CustomUser.objects.all().delete()
         Token.objects.all().delete()
@@ -207,33 +434,55 @@ class TestAccess(APITestCase):
 
     def test_access_phone_notok(self, mock):
         url = reverse("access-phone")
-        # empty mail queue
-        mail.outbox = []
 
         response = self.client.post(
             url, {"deviceid": self.device.deviceid, "payload": self.fail_user.phone}
         )
+        self.assertEqual(response.status_code, 481)
 
-        # check that we notified the user by email of this failure
-        self.assertIn("Hei", mail.outbox[0].body, "Hei")
+        # the user is notified by email of this failure outside the request
+        self.assertEqual(Message.objects.count(), 0)
+        self._notify_door_access_denied()
+        self.assertEqual(Message.objects.count(), 1)
+        message = Message.objects.first()
+        self.assertEqual(message.email.to, [self.fail_user.email])
+        self.assertIn("Hei", message.email.body, "Hei")
         self.assertIn(
             "Käyttäjätililläsi ei ole tällähetkellä pääsyä oveen.",
-            mail.outbox[0].body,
+            message.email.body,
             "failure notification intro text",
         )
         # list of services in the mail
         self.assertIn(
             f"{self.fail_user.servicesubscription_set.first().service.name}: {self.fail_user.servicesubscription_set.first().state}",
-            mail.outbox[0].body,
+            message.email.body,
             "first ss state",
         )
-        self.assertIn(Site.objects.get_current().domain, mail.outbox[0].body, "siteurl")
+        self.assertIn(Site.objects.get_current().domain, message.email.body, "siteurl")
+
+        # the user is notified only once for repeated attempts
+        response = self.client.post(
+            url, {"deviceid": self.device.deviceid, "payload": self.fail_user.phone}
+        )
         self.assertEqual(response.status_code, 481)
+        self._notify_door_access_denied()
+        self.assertEqual(Message.objects.count(), 1)
+
+        # but again after the interval
+        UsersLog.objects.filter(message=DOOR_ACCESS_DENIED_NOTIFIED).update(
+            date=timezone.now()
+            - timezone.timedelta(seconds=config.DOOR_ACCESS_DENIED_NOTIFY_INTERVAL + 1)
+        )
+        self.client.post(
+            url, {"deviceid": self.device.deviceid, "payload": self.fail_user.phone}
+        )
+        self._notify_door_access_denied()
+        self.assertEqual(Message.objects.count(), 2)
 
     @override_settings(
         EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
         EMAIL_HOST="example.com",
-        EMAIL_TIMEOUT=1  # just to be fast in tests
+        EMAIL_TIMEOUT=1,  # just to be fast in tests
     )
     def test_access_phone_notok_signal_fail(self, mock):
         """
@@ -253,10 +502,38 @@ class TestAccess(APITestCase):
 
         # still getting a correct status (not 500)
         self.assertEqual(response.status_code, 481)
+        response = self.client.post(
+            url, {"deviceid": self.device.deviceid, "payload": self.fail_user.phone}
+        )
+        self.assertEqual(response.status_code, 481)
+
+        # both denials are logged but the user is notified once, the mail is
+        # only queued so the broken smtp does not matter
+        self._notify_door_access_denied()
+        self._notify_door_access_denied()
+        self.assertEqual(
+            UsersLog.objects.filter(
+                user=self.fail_user, message=DOOR_ACCESS_DENIED.format("phone")
+            ).count(),
+            2,
+        )
+        self.assertEqual(
+            UsersLog.objects.filter(
+                user=self.fail_user, message=DOOR_ACCESS_DENIED_NOTIFIED
+            ).count(),
+            1,
+        )
+        self.assertEqual(Message.objects.count(), 1)
 
         # no email in outbox (just shows that we are not using the memory backend)
         self.assertEqual(len(mail.outbox), 0)
 
+    @staticmethod
+    def _notify_door_access_denied():
+        BusinessLogic.notify_door_access_denied(
+            BusinessLogic.find_door_access_denials()
+        )
+
     def test_access_phone_empty(self, mock):
         url = reverse("access-phone")
         response = self.client.post(
@@ -343,6 +620,284 @@ class TestAccess(APITestCase):
         )
         self.assertEqual(response.status_code, 481)
 
+    def test_access_decision_cached(self, mock):
+        url = reverse("access-nfc")
+        data = {"deviceid": self.device.deviceid, "payload": self.ok_card.cardid}
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # second time the user is not looked up
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["email"], self.ok_user.email)
+        self.assertFalse(
+            any("users_nfccard" in query["sql"] for query in queries.captured_queries)
+        )
+
+        # subscription change is noticed
+        self.ok_subscription.state = ServiceSubscription.SUSPENDED
+        self.ok_subscription.save()
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 481)
+
+        # and so is card removal
+        self.ok_card.delete()
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 480)
+
+    def test_access_grants_maintained(self, mock):
+        def granted(method, credential):
+            return AccessGrant.objects.get(method=method, credential=credential).granted
+
+        self.assertTrue(granted("phone", self.ok_user.phone))
+        self.assertTrue(granted("mxid", self.ok_user.mxid))
+        self.assertTrue(granted("nfc", self.ok_card2.cardid))
+        self.assertFalse(granted("nfc", self.not_ok_card.cardid))
+
+        # subscription state change
+        self.fail_subscription.state = ServiceSubscription.ACTIVE
+        self.fail_subscription.save()
+        self.assertTrue(granted("nfc", self.not_ok_card.cardid))
+
+        # and the same without post_save
+        self.fail_subscription.state = ServiceSubscription.OVERDUE
+        ServiceSubscription.objects.bulk_update([self.fail_subscription], ["state"])
+        subscriptions_changed.send(
+            ServiceSubscription, subscriptions=[self.fail_subscription]
+        )
+        self.assertFalse(granted("nfc", self.not_ok_card.cardid))
+
+        # user deactivation
+        self.ok_user.is_active = False
+        self.ok_user.save()
+        self.assertFalse(granted("phone", self.ok_user.phone))
+        self.ok_user.is_active = True
+        self.ok_user.save()
+
+        # old phone number is revoked
+        old_phone = self.ok_user.phone
+        self.ok_user.phone = "+35844055067"
+        self.ok_user.save()
+        self.assertFalse(granted("phone", old_phone))
+        self.assertTrue(granted("phone", "+35844055067"))
+
+        # card removed
+        self.ok_card.delete()
+        self.assertFalse(granted("nfc", self.ok_card.cardid))
+        self.assertTrue(granted("nfc", self.ok_card2.cardid))
+
+        # user removed
+        self.ok_user.delete()
+        self.assertFalse(granted("nfc", self.ok_card2.cardid))
+        self.assertFalse(AccessGrant.objects.filter(user__isnull=False, granted=True))
+
+    def test_access_check_one_lookup(self, mock):
+        url = reverse("access-nfc")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                url, {"deviceid": self.device.deviceid, "payload": self.ok_card.cardid}
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lookups = [
+            query["sql"]
+            for query in queries.captured_queries
+            if "users_nfccard" in query["sql"]
+            or "users_servicesubscription" in query["sql"]
+        ]
+        self.assertEqual(lookups, [])
+
+    def test_allowlist(self, mock):
+        url = reverse("access-allowlist")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        auth = {"HTTP_AUTHORIZATION": f"Token {self.superuser_token}"}
+
+        response = self.client.get(url, **auth)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        version = response.data["version"]
+        self.assertEqual(response["ETag"], f'"{version}"')
+        credentials = {
+            (grant["method"], grant["credential"]) for grant in response.data["granted"]
+        }
+        self.assertIn(("phone", self.ok_user.phone), credentials)
+        self.assertIn(("nfc", self.ok_card.cardid), credentials)
+        self.assertIn(("mxid", self.ok_user.mxid), credentials)
+        self.assertNotIn(("nfc", self.not_ok_card.cardid), credentials)
+        self.assertEqual(
+            response.data["granted"][0]["user"]["email"], "test1@example.com"
+        )
+
+        # nothing changed
+        response = self.client.get(
+            url, {"since": version}, HTTP_IF_NONE_MATCH=f'"{version}"', **auth
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # changes since the version
+        self.ok_card.delete()
+        self.fail_subscription.state = ServiceSubscription.ACTIVE
+        self.fail_subscription.save()
+        response = self.client.get(
+            url, {"since": version}, HTTP_IF_NONE_MATCH=f'"{version}"', **auth
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(response.data["version"], version)
+        self.assertEqual(
+            response.data["revoked"], [{"method": "nfc", "credential": "ABC123TEST"}]
+        )
+        self.assertEqual(
+            {
+                (grant["method"], grant["credential"])
+                for grant in response.data["granted"]
+            },
+            {
+                ("phone", self.fail_user.phone),
+                ("mxid", self.fail_user.mxid),
+                ("nfc", self.not_ok_card.cardid),
+            },
+        )
+
+        response = self.client.get(url, {"since": "x"}, **auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(
+        ACCESS_ALLOWLIST_MAX_WAIT=0.2, ACCESS_ALLOWLIST_POLL_INTERVAL=0.01
+    )
+    def test_allowlist_wait(self, mock):
+        url = reverse("access-allowlist")
+        auth = {"HTTP_AUTHORIZATION": f"Token {self.superuser_token}"}
+        self.assertEqual(
+            self.client.get(url, {"deviceid": "unknown"}, **auth).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+        version = AccessListVersion.current()
+
+        # nothing changes while waiting
+        started = time.monotonic()
+        response = self.client.get(
+            url,
+            {"deviceid": self.device.deviceid, "since": version, "wait": 60},
+            **auth,
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertLess(time.monotonic() - started, 10)
+
+        # the wait is not rounded up to the poll interval
+        started = time.monotonic()
+        with override_settings(ACCESS_ALLOWLIST_POLL_INTERVAL=5):
+            response = self.client.get(
+                url,
+                {"deviceid": self.device.deviceid, "since": version, "wait": 0.01},
+                **auth,
+            )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertLess(time.monotonic() - started, 1)
+
+        # a newer version is returned right away
+        self.ok_card.delete()
+        response = self.client.get(
+            url,
+            {"deviceid": self.device.deviceid, "since": version, "wait": 60},
+            **auth,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["version"], AccessListVersion.current())
+        self.assertEqual(
+            response.data["revoked"], [{"method": "nfc", "credential": "ABC123TEST"}]
+        )
+
+        response = self.client.get(url, {"since": version, "wait": "x"}, **auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # the polls are not saved to the api request log, the failed ones are
+        self.assertEqual(
+            list(
+                APIRequestLog.objects.filter(path=url)
+                .order_by("id")
+                .values_list("status_code", flat=True)
+            ),
+            [404, 400],
+        )
+
+        # only ACCESS_ALLOWLIST_MAX_WAITING requests wait at the same time
+        version = AccessListVersion.current()
+        with patch("api.views.allowlist_waiters", threading.BoundedSemaphore(1)):
+            with views.allowlist_waiters:
+                response = self.client.get(url, {"since": version, "wait": 60}, **auth)
+                self.assertEqual(
+                    response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+                )
+                self.assertIn("Retry-After", response.headers)
+            response = self.client.get(url, {"since": version, "wait": 60}, **auth)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_batch(self, mock):
+        url = reverse("access-batch")
+        swiped = timezone.now() - timezone.timedelta(hours=2)
+        items = [
+            {"method": "nfc", "payload": self.ok_card.cardid},
+            {"method": "nfc", "payload": self.not_ok_card.cardid},
+            {"method": "nfc", "payload": "doesnotexists"},
+            {"method": "phone", "payload": "0035844055066"},
+            {"method": "mxid", "payload": self.fail_user.mxid},
+        ]
+        for item in items:
+            item["timestamp"] = swiped.isoformat()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                url, {"deviceid": self.device.deviceid, "items": items}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["status"] for result in response.data["results"]],
+            [0, 481, 480, 0, 481],
+        )
+        self.assertEqual(
+            response.data["results"][0]["user"]["email"], self.ok_user.email
+        )
+        self.assertIsNone(response.data["results"][2]["user"])
+
+        inserts = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith('INSERT INTO "api_deviceaccesslogentry"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        inserts = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith('INSERT INTO "users_userslog"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        entries = DeviceAccessLogEntry.objects.order_by("id")
+        self.assertEqual(
+            [entry.granted for entry in entries], [True, False, False, True, False]
+        )
+        self.assertEqual(entries[0].date, swiped)
+        self.assertEqual(entries[3].payload, self.ok_user.phone)
+        # one notification for the two denied swipes
+        self._notify_door_access_denied()
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_batch_invalid(self, mock):
+        url = reverse("access-batch")
+        response = self.client.post(
+            url, {"deviceid": self.device.deviceid, "items": []}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        item = {"method": "ssh", "payload": "x", "timestamp": timezone.now()}
+        response = self.client.post(
+            url, {"deviceid": self.device.deviceid, "items": [item]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        item["method"] = "nfc"
+        response = self.client.post(
+            url, {"deviceid": "not_a_valid_device", "items": [item]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_unknown_mxid_device(self, mock):
         url = reverse("access-mxid")
         response = self.client.post(
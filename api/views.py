@@ -1,23 +1,45 @@
 import logging
-
-from django.shortcuts import get_object_or_404
-
-from api.serializers import AccessDataSerializer, UserAccessSerializer
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.http import Http404
+
+from api.serializers import (
+    AccessBatchSerializer,
+    AccessDataSerializer,
+    AccessGrantSerializer,
+    RevokedAccessSerializer,
+    UserAccessSerializer,
+)
 from drfx import config as config
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.throttling import AnonRateThrottle
 from rest_framework_tracking.mixins import LoggingMixin
-from users.models import CustomUser, ServiceSubscription
+from rest_framework_tracking.models import APIRequestLog
+from users.models import CustomUser, ServiceSubscription, UsersLog
 
 from utils.phonenumber import normalize_number
 
-from .models import AccessDevice, DeviceAccessLogEntry
-from users.signals import door_access_denied
+from .accesscache import AccessCache
+from .bulkwriter import BulkWriter
+from .deviceregistry import DeviceRegistry
+from .models import AccessGrant, AccessListVersion, DeviceAccessLogEntry
+from users.signals import DOOR_ACCESS_DENIED
 
 logger = logging.getLogger(__name__)
 
+# door access log is written in the background
+access_log_writer = BulkWriter(DeviceAccessLogEntry)
+# and so are the api request logs with the deferred ACCESS_API_LOG_POLICY
+api_log_writer = BulkWriter(APIRequestLog)
+# the threads door controllers can hold waiting for allowlist changes, gunicorn
+# has more threads than this so that they are never all waiting
+allowlist_waiters = threading.BoundedSemaphore(config.ACCESS_ALLOWLIST_MAX_WAITING)
+
 
 class VerySlowThrottle(AnonRateThrottle):
     """
@@ -27,7 +49,70 @@ class VerySlowThrottle(AnonRateThrottle):
     rate = "10/minute"
 
 
-class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+class AccessLoggingMixin(LoggingMixin):
+    """
+    LoggingMixin that follows ACCESS_API_LOG_POLICY
+
+    full logs every request, errors only the failed ones, sampled the failed ones
+    and ACCESS_API_LOG_SAMPLE_RATE of the others and deferred every request but
+    writes them in the background. Denied access and other errors are always logged,
+    also when they are items of a batch.
+    The successful allowlist polls are never logged, they are frequent and the
+    snapshots contain the personal data of all the members.
+    """
+
+    LOG_POLICIES = ("full", "errors", "sampled", "deferred")
+
+    @staticmethod
+    def log_policy():
+        """
+        The configured policy, an unknown one is logged and handled as full so
+        that a typo does not break the door. See also api/checks.py
+        """
+        policy = config.ACCESS_API_LOG_POLICY
+        if policy not in AccessLoggingMixin.LOG_POLICIES:
+            logger.error(f"Unknown ACCESS_API_LOG_POLICY {policy!r}, using full")
+            return "full"
+        return policy
+
+    def should_log(self, request, response):
+        policy = AccessLoggingMixin.log_policy()
+        if not super().should_log(request, response):
+            return False
+        if response.status_code >= 400:
+            return True
+        if getattr(self, "action", None) == "allowlist":
+            return False
+        if AccessLoggingMixin.has_failed_items(response):
+            return True
+        if policy == "errors":
+            return False
+        if policy == "sampled":
+            return random.random() < config.ACCESS_API_LOG_SAMPLE_RATE
+        return True
+
+    @staticmethod
+    def has_failed_items(response):
+        """
+        The batch endpoint returns 200 with a status for every item, a denied
+        or unknown item counts as an error
+        """
+        data = getattr(response, "data", None)
+        if not isinstance(data, dict) or not isinstance(data.get("results"), list):
+            return False
+        return any(
+            isinstance(item, dict) and item.get("status", 0) >= 400
+            for item in data["results"]
+        )
+
+    def handle_log(self):
+        if AccessLoggingMixin.log_policy() == "deferred":
+            api_log_writer.add(APIRequestLog(**self.log))
+        else:
+            super().handle_log()
+
+
+class AccessViewSet(AccessLoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     """
     Access checker api
 
@@ -55,9 +140,8 @@ class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet
         inserializer.is_valid(raise_exception=True)
 
         # check that we know which device this is
-        deviceqs = AccessDevice.objects.all()
         deviceid = inserializer.validated_data.get("deviceid")
-        device = get_object_or_404(deviceqs, deviceid=deviceid)
+        device = AccessViewSet.get_device(deviceid)
         logging.debug(f"found device {device}")
 
         access_token = inserializer.validated_data.get("payload")
@@ -65,13 +149,10 @@ class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet
             # phone number comes in payload, but it is in a wrong format
             # the number will most probably start with 00 instead of +
             access_token = normalize_number(access_token)
-        users = []
-        if method == "phone":
-            users = CustomUser.objects.filter(phone=access_token)
-        elif method == "nfc":
-            users = CustomUser.objects.filter(nfccard__cardid=access_token)
-        elif method == "mxid":
-            users = CustomUser.objects.filter(mxid=access_token)
+
+        decision = AccessCache.get(method, access_token)
+        if decision is None:
+            decision = AccessViewSet.access_decision(method, access_token)
 
         logentry.device = device
         logentry.payload = access_token
@@ -81,43 +162,62 @@ class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet
         response_status = 0
 
         # nothing found, 480 (NO_CONTENT)
-        if users.count() == 0:
+        if decision.user_id is None:
             logentry.granted = False
-            logentry.save()
+            access_log_writer.add(logentry)
             return Response(status=480)
 
-        # planned database scheme says that
-        # phone numbers, MXIDs, nfc tags are/will be unique
-        user = users.first()
-
         # user does not have access rights
-        if not user.has_door_access():
+        if not decision.granted:
             response_status = 481
 
         logentry.granted = response_status == 0
-        logentry.save()
+        access_log_writer.add(logentry)
+
+        # uppercase NFC and MXID
+        method_name = method if method == "phone" else method.upper()
 
         if response_status == 0:
-            if method != "phone":
-                # uppercase NFC and MXID
-                user.log(f"Door opened with {method.upper()}")
-            else:
-                user.log(f"Door opened with {method}")
-            outserializer = UserAccessSerializer(user)
-            return Response(outserializer.data)
+            UsersLog.objects.add(decision.user_id, f"Door opened with {method_name}")
+            return Response(decision.data)
 
         if response_status == 481:
-            if method != "phone":
-                # uppercase NFC and MXID
-                user.log(f"Door access denied with {method.upper()}")
-            else:
-                user.log(f"Door access denied with {method}")
-            door_access_denied.send(sender=self.__class__, user=user, method=method)
-            outserializer = UserAccessSerializer(user)
-            return Response(outserializer.data, status=response_status)
+            # the user is notified by the notify_door_access_denied job
+            UsersLog.objects.add(
+                decision.user_id, DOOR_ACCESS_DENIED.format(method_name)
+            )
+            return Response(decision.data, status=response_status)
 
         return Response(status=response_status)
 
+    @staticmethod
+    def get_device(deviceid):
+        device = DeviceRegistry.get(deviceid)
+        if device is None:
+            raise Http404("No AccessDevice matches the given query.")
+        return device
+
+    @staticmethod
+    def access_decision(method, access_token):
+        """
+        Look up the access grant of the access token, the result is cached
+        """
+        grant = (
+            AccessGrant.objects.filter(method=method, credential=access_token)
+            .select_related("user")
+            .first()
+        )
+        if grant is None or grant.user is None:
+            return AccessCache.set(method, access_token, None, False, None)
+
+        return AccessCache.set(
+            method,
+            access_token,
+            grant.user_id,
+            grant.granted,
+            UserAccessSerializer(grant.user).data,
+        )
+
     @action(detail=False, methods=["post"], throttle_classes=[VerySlowThrottle])
     def phone(self, request, format=None):
         """
@@ -147,6 +247,79 @@ class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet
         """
         return AccessViewSet.access_token_abstraction(self, request, format, "mxid")
 
+    @action(detail=False, methods=["post"], throttle_classes=[VerySlowThrottle])
+    def batch(self, request, format=None):
+        """
+        Check many access attempts of one device at once, for devices that replay
+        the attempts they buffered while offline
+
+        call with deviceid and items list of method (phone, nfc or mxid), payload
+        and timestamp. Returns results list with status 0, 480 or 481 and the user
+        data for each item like the single endpoints.
+        """
+        inserializer = AccessBatchSerializer(data=request.data)
+        inserializer.is_valid(raise_exception=True)
+
+        deviceid = inserializer.validated_data.get("deviceid")
+        device = AccessViewSet.get_device(deviceid)
+
+        items = inserializer.validated_data.get("items")
+        for item in items:
+            if item["method"] == "phone":
+                item["payload"] = normalize_number(item["payload"])
+
+        # the credentials with one query per method
+        credentials = defaultdict(set)
+        for item in items:
+            credentials[item["method"]].add(item["payload"])
+        grants = {}
+        for method, payloads in credentials.items():
+            for grant in AccessGrant.objects.filter(
+                method=method, credential__in=payloads
+            ).select_related("user"):
+                grants[(grant.method, grant.credential)] = grant
+
+        results = []
+        logentries = []
+        # the users' log entries are written with one query
+        with UsersLog.objects.deferred():
+            for item in items:
+                method = item["method"]
+                grant = grants.get((method, item["payload"]))
+                logentry = DeviceAccessLogEntry(
+                    date=item["timestamp"],
+                    device=device,
+                    payload=item["payload"],
+                    method=method,
+                    granted=False,
+                )
+                logentries.append(logentry)
+
+                # nothing found, 480 (NO_CONTENT)
+                if grant is None or grant.user is None:
+                    results.append({"status": 480, "user": None})
+                    continue
+
+                method_name = method if method == "phone" else method.upper()
+                if grant.granted:
+                    logentry.granted = True
+                    message = f"Door opened with {method_name}"
+                    response_status = 0
+                else:
+                    message = DOOR_ACCESS_DENIED.format(method_name)
+                    response_status = 481
+                grant.user.log(message)
+                results.append(
+                    {
+                        "status": response_status,
+                        "user": UserAccessSerializer(grant.user).data,
+                    }
+                )
+
+        DeviceAccessLogEntry.objects.bulk_create(logentries)
+
+        return Response({"results": results})
+
     @phone.mapping.get
     def phone_list(self, request, format=None):
         """
@@ -169,5 +342,84 @@ class AccessViewSet(LoggingMixin, mixins.ListModelMixin, viewsets.GenericViewSet
         outserializer = UserAccessSerializer(users_with_door_access, many=True)
         return Response(outserializer.data)
 
+    @action(detail=False, methods=["get"])
+    def allowlist(self, request, format=None):
+        """
+        Versioned list of the credentials that open the door, for door controllers
+        that keep their own copy of it
+
+        Without parameters returns all the granted credentials. With ?since=<version>
+        returns only the credentials granted and revoked after that version.
+
+        The version is also the ETag, polling with If-None-Match returns 304 when
+        nothing has changed. With ?since=<version>&wait=<seconds> the request waits
+        for a newer version for at most ACCESS_ALLOWLIST_MAX_WAIT seconds and
+        returns 304 if there is none. When ACCESS_ALLOWLIST_MAX_WAITING requests
+        are already waiting returns 503 with Retry-After instead.
+        ?deviceid=<deviceid> must be a known device.
+        """
+        # only for superusers
+        if not request.user or not request.user.is_superuser:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+        deviceid = request.query_params.get("deviceid")
+        if deviceid is not None:
+            AccessViewSet.get_device(deviceid)
+
+        try:
+            since = request.query_params.get("since")
+            if since is not None:
+                since = int(since)
+            wait = float(request.query_params.get("wait", 0))
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        version = AccessListVersion.current()
+        if since is not None and wait > 0 and version <= since:
+            if not allowlist_waiters.acquire(blocking=False):
+                return Response(
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={"Retry-After": str(config.ACCESS_ALLOWLIST_MAX_WAIT)},
+                )
+            try:
+                # the version is read from the database so changes made by other
+                # processes are seen too
+                deadline = time.monotonic() + min(
+                    wait, config.ACCESS_ALLOWLIST_MAX_WAIT
+                )
+                remaining = deadline - time.monotonic()
+                while version <= since and remaining > 0:
+                    time.sleep(min(config.ACCESS_ALLOWLIST_POLL_INTERVAL, remaining))
+                    version = AccessListVersion.current()
+                    remaining = deadline - time.monotonic()
+            finally:
+                allowlist_waiters.release()
+
+        etag = f'"{version}"'
+        if request.headers.get("If-None-Match") == etag or (
+            wait > 0 and since is not None and version <= since
+        ):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        grants = AccessGrant.objects.select_related("user").order_by("version", "id")
+        if since is None:
+            granted = grants.filter(granted=True, user__isnull=False)
+            revoked = []
+        else:
+            # newer changes are in the next version
+            changed = grants.filter(version__gt=since, version__lte=version)
+            granted = [grant for grant in changed if grant.granted and grant.user]
+            revoked = [
+                grant for grant in changed if not grant.granted or not grant.user
+            ]
+
+        data = {
+            "version": version,
+            "since": since,
+            "granted": AccessGrantSerializer(granted, many=True).data,
+            "revoked": RevokedAccessSerializer(revoked, many=True).data,
+        }
+        return Response(data, headers={"ETag": etag})
+
     def list(self, request):
         return Response(status=status.HTTP_501_NOT_IMPLEMENTED)
@@ -0,0 +1,36 @@
+# gunicorn settings, used by entrypoint.sh
+# https://docs.gunicorn.org/en/stable/settings.html
+
+from drfx import settings
+
+bind = "0.0.0.0:8000"
+
+# One worker process. The access decisions, devices and member services are
+# cached in the process and the cached copies are invalidated by the signals of
+# the process that changes them, with more workers the others would keep using
+# stale copies (a revoked card would still open the door) until they expire.
+workers = 1
+
+# Threaded so that a door controller waiting for allowlist changes holds a thread
+# and not the whole worker. The waiting controllers can use at most
+# ACCESS_ALLOWLIST_MAX_WAITING threads, the rest are left for the door access
+# requests and the web pages. The waits (ACCESS_ALLOWLIST_MAX_WAIT) are shorter
+# than the timeout
+worker_class = "gthread"
+threads = settings.ACCESS_ALLOWLIST_MAX_WAITING + 8
+timeout = 30
+
+
+# write the queued access and api logs before the worker goes away, on a normal
+# exit and when the worker is aborted because of the timeout. A worker killed
+# with SIGKILL loses what was queued, see ACCESS_LOG_FLUSH_INTERVAL
+def worker_exit(server, worker):
+    from api.bulkwriter import BulkWriter
+
+    BulkWriter.flush_all()
+
+
+def worker_abort(worker):
+    from api.bulkwriter import BulkWriter
+
+    BulkWriter.flush_all()
@@ -23,6 +23,56 @@ DEFAULT_ACCOUNT_SERVICE = 2
 CUSTOM_INVOICE_REFERENCE_BASE = 10000
 SERVICE_INVOICE_REFERENCE_BASE = 20000
 
+# How many bank transactions are looked up and inserted at a time when importing
+IMPORT_BATCH_SIZE = 500
+
+# Member services and their payment chains are kept in memory for this many
+# seconds, changes made in other processes are noticed after this
+SERVICE_GRAPH_TIMEOUT = 300
+
+# How many days before the latest imported booking date transactions are fetched
+# from Nordigen again, banks can book transactions with earlier dates late
+NORDIGEN_FETCH_OVERLAP_DAYS = 7
+
+# How many Nordigen accounts are fetched at the same time
+NORDIGEN_FETCH_WORKERS = 4
+
+# How many seconds door access decisions are cached in each process. Changes made
+# in other processes, like the daily jobs, are noticed after this
+ACCESS_CACHE_TIMEOUT = 60
+
+# Access devices are kept in memory for this many seconds and unknown device ids
+# are remembered for ACCESS_DEVICE_UNKNOWN_TIMEOUT seconds
+ACCESS_DEVICE_CACHE_TIMEOUT = 300
+ACCESS_DEVICE_UNKNOWN_TIMEOUT = 30
+
+# Door access log entries are written in the background every this many seconds,
+# or when this many are waiting. 0 writes them right away. The queue is written
+# when a gunicorn worker exits or is aborted, but a worker killed with SIGKILL
+# (or by the OOM killer) loses the entries of up to this many seconds
+ACCESS_LOG_FLUSH_INTERVAL = 2
+ACCESS_LOG_FLUSH_SIZE = 100
+
+# Door controllers can wait for allowlist changes for at most this many seconds,
+# keep it below the gunicorn worker timeout. The version is checked every
+# ACCESS_ALLOWLIST_POLL_INTERVAL seconds while waiting
+ACCESS_ALLOWLIST_MAX_WAIT = 20
+ACCESS_ALLOWLIST_POLL_INTERVAL = 1
+# At most this many of them wait at the same time, gunicorn is given this many
+# threads more than it needs for the other requests, see drfx/gunicorn.py
+ACCESS_ALLOWLIST_MAX_WAITING = 4
+
+# Which requests to the access api are saved to the api request log:
+# "full", "errors", "sampled" (errors and ACCESS_API_LOG_SAMPLE_RATE of the others)
+# or "deferred" (everything, written in the background). Denials are always saved.
+# Any other value fails the system checks and is handled as "full"
+ACCESS_API_LOG_POLICY = "full"
+ACCESS_API_LOG_SAMPLE_RATE = 0.1
+
+# A user whose door access was denied is mailed at most once in this many seconds,
+# the denials are picked up by the minutely notify_door_access_denied job
+DOOR_ACCESS_DENIED_NOTIFY_INTERVAL = 3600
+
 MEMBERSHIP_APPLICATION_NOTIFY_ADDRESS = "example@example.com"
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -341,6 +391,8 @@ logging.config.dictConfig(
 
 if len(sys.argv) > 1 and sys.argv[1] == "test":
     logging.disable(logging.CRITICAL)
+    # tests run inside transactions that the background writer can not see
+    ACCESS_LOG_FLUSH_INTERVAL = 0
 
 LOGIN_URL = "login"
 LOGIN_REDIRECT_URL = "/"
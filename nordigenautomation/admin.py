@@ -25,6 +25,7 @@ class ConfigAdmin(admin.ModelAdmin):
     list_filter = ("country", "institution")
     inlines = [RequisitionInline]
     readonly_fields = ["config_actions"]
+    exclude = Config.TOKEN_FIELDS
 
     def get_urls(self):
         """
@@ -0,0 +1,143 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+from drfx import config
+from utils.dataimport import DataImport
+
+from .models import Requisition
+
+logger = logging.getLogger(__name__)
+
+
+class TransactionFetcher:
+    """
+    Fetches the transactions of all the accounts of the active requisitions
+
+    The accounts are fetched at the same time with at most NORDIGEN_FETCH_WORKERS
+    threads and the booked transactions of all of them are imported in one go.
+    An account that fails is logged and left out, the others are still imported.
+    The threads only talk to the Nordigen api through Config._call_api, the
+    database is only touched there when a rejected token is replaced.
+    """
+
+    def __init__(self, requisitions=None, full_resync=False):
+        if requisitions is None:
+            requisitions = Requisition.active.select_related("config")
+        self.requisitions = list(requisitions)
+        self.full_resync = full_resync
+        # one row per account: requisition, account_id, seconds, booked, error
+        self.accounts = []
+
+    def run(self):
+        """
+        Fetch, import and move the requisitions forward
+
+        Returns the import results
+        """
+        fetched = self._fetch()
+
+        booked = []
+        for requisition, transactions in fetched:
+            booked += transactions["transactions"]["booked"]
+        results = DataImport.import_nordigen(
+            {"transactions": {"booked": booked, "pending": []}}
+        )
+
+        # requisitions with failed accounts are fetched from the old date next time
+        failed = {row["requisition"] for row in self.accounts if row["error"]}
+        for requisition, transactions in fetched:
+            if requisition.id not in failed:
+                requisition.update_last_booking_date(transactions)
+
+        return results
+
+    def _fetch(self):
+        """
+        Returns list of (requisition, transactions) where transactions has the booked
+        transactions of the accounts of the requisition that could be fetched
+        """
+        # one config instance per config so the tokens are only generated once.
+        # A rejected token is replaced here before the accounts are fetched
+        configs = {}
+        jobs = []
+        for requisition in self.requisitions:
+            date_from = requisition.get_fetch_date_from(self.full_resync)
+            if date_from:
+                date_from = date_from.strftime("%Y-%m-%d")
+            try:
+                nordigen_config = configs.setdefault(
+                    requisition.config_id, requisition.config
+                )
+                accounts = nordigen_config._call_api(
+                    lambda client: client.requisition.get_requisition_by_id(
+                        requisition_id=requisition.requisition_id
+                    )
+                )
+            except Exception as e:
+                logger.exception(f"Getting accounts for {requisition.id} failed: {e}")
+                self.accounts.append(
+                    {
+                        "requisition": requisition.id,
+                        "account_id": None,
+                        "seconds": 0,
+                        "booked": 0,
+                        "error": str(e),
+                    }
+                )
+                continue
+            for account_id in accounts["accounts"]:
+                jobs.append((requisition, nordigen_config, account_id, date_from))
+
+        with ThreadPoolExecutor(max_workers=config.NORDIGEN_FETCH_WORKERS) as pool:
+            results = list(pool.map(lambda job: self._fetch_account(*job), jobs))
+
+        fetched = {
+            requisition.id: (
+                requisition,
+                {"transactions": {"booked": [], "pending": []}},
+            )
+            for requisition in self.requisitions
+        }
+        for (requisition, nordigen_config, account_id, date_from), (row, booked) in zip(
+            jobs, results
+        ):
+            self.accounts.append(row)
+            fetched[requisition.id][1]["transactions"]["booked"] += booked
+        return list(fetched.values())
+
+    @staticmethod
+    def _fetch_account(requisition, nordigen_config, account_id, date_from):
+        """
+        Fetch booked transactions of one account, run in the pool
+        """
+        start = time.monotonic()
+        booked = []
+        error = None
+        try:
+            transactions = nordigen_config._call_api(
+                lambda client: client.account_api(id=account_id).get_transactions(
+                    date_from=date_from
+                )
+            )
+            booked = transactions["transactions"]["booked"]
+        except Exception as e:
+            logger.exception(f"Fetching account {account_id} failed: {e}")
+            error = str(e)
+        finally:
+            # the connection opened for a replaced token is not left to the thread
+            connections.close_all()
+        seconds = time.monotonic() - start
+        logger.info(
+            f"Fetched {len(booked)} transactions from account {account_id} in {seconds:.2f}s"
+        )
+        row = {
+            "requisition": requisition.id,
+            "account_id": account_id,
+            "seconds": seconds,
+            "booked": len(booked),
+            "error": error,
+        }
+        return row, booked
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nordigenautomation", "0002_alter_config_country_alter_config_institution"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="requisition",
+            name="last_booking_date",
+            field=models.DateField(
+                blank=True,
+                help_text="Only transactions after this are fetched, empty fetches all",
+                null=True,
+                verbose_name="Latest booking date of imported transactions",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nordigenautomation", "0003_requisition_last_booking_date"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="config",
+            name="access_expires",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="config",
+            name="access_token",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="config",
+            name="institution_id",
+            field=models.CharField(blank=True, max_length=256),
+        ),
+        migrations.AddField(
+            model_name="config",
+            name="refresh_expires",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="config",
+            name="refresh_token",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -1,5 +1,7 @@
+import logging
+import threading
 from uuid import uuid4
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from django.utils import timezone
 from django.db import models
@@ -7,6 +9,11 @@ from django.utils.translation import gettext_lazy as _
 from django.contrib.sites.models import Site
 
 from nordigen import NordigenClient
+from requests.models import HTTPError
+
+from drfx import config as settings_config
+
+logger = logging.getLogger(__name__)
 
 
 class Config(models.Model):
@@ -77,6 +84,14 @@ class Config(models.Model):
         choices=NORDIGEN_INSTITUTION_CHOICES,
     )
 
+    # Tokens and institution id from the api are stored so that they are
+    # only fetched again when they expire or the settings change
+    access_token = models.TextField(blank=True)
+    access_expires = models.DateTimeField(blank=True, null=True)
+    refresh_token = models.TextField(blank=True)
+    refresh_expires = models.DateTimeField(blank=True, null=True)
+    institution_id = models.CharField(blank=True, max_length=256)
+
     created = models.DateTimeField(
         auto_now_add=True,
         verbose_name=_("Creation date"),
@@ -100,23 +115,152 @@ class Config(models.Model):
             requisition = None
         return requisition
 
+    # Fields that make the stored tokens and institution id invalid when changed
+    API_FIELDS = ["api_id", "api_key", "country", "institution"]
+    TOKEN_FIELDS = [
+        "access_token",
+        "access_expires",
+        "refresh_token",
+        "refresh_expires",
+        "institution_id",
+    ]
+
+    # Tokens are renewed a bit before they really expire
+    TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+    # The transaction fetcher calls the api of one config from several threads,
+    # the client and the tokens are created and replaced one thread at a time
+    token_lock = threading.RLock()
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            old = Config.objects.filter(pk=self.pk).values(*self.API_FIELDS).first()
+            if old and any(old[field] != getattr(self, field) for field in old):
+                self._clear_tokens()
+        super().save(*args, **kwargs)
+
+    def _clear_tokens(self):
+        self.access_token = ""
+        self.access_expires = None
+        self.refresh_token = ""
+        self.refresh_expires = None
+        self.institution_id = ""
+        if hasattr(self, "_client"):
+            del self._client
+
+    def _forget_tokens(self):
+        """
+        Forget the stored tokens after the api has rejected them
+        """
+        self.access_token = ""
+        self.access_expires = None
+        self.refresh_token = ""
+        self.refresh_expires = None
+        if hasattr(self, "_client"):
+            del self._client
+        if self.pk:
+            Config.objects.filter(pk=self.pk).update(
+                access_token="",
+                access_expires=None,
+                refresh_token="",
+                refresh_expires=None,
+            )
+
+    @staticmethod
+    def _is_unauthorized(error):
+        return error.response is not None and error.response.status_code == 401
+
     def _get_client(self) -> NordigenClient:
         """
         Get nordigen client
+
+        Uses the stored access token until it expires. A new access token is
+        exchanged with the stored refresh token and a new token pair is only
+        generated when the refresh token has expired too or is rejected.
         """
         if not hasattr(self, "_client"):
             self._client = NordigenClient(
                 secret_id=self.api_id, secret_key=self.api_key
             )
-            self._token_data = self._client.generate_token()
-            self._token = self._client.exchange_token(self._token_data["refresh"])
-
-            self._institution_id = self._client.institution.get_institution_id_by_name(
-                country=self.country, institution=self.institution
-            )
+            now = timezone.now()
+            valid_after = now + self.TOKEN_EXPIRY_MARGIN
+            changed = False
+            generate = True
+
+            if self.access_expires and self.access_expires > valid_after:
+                self._client.token = self.access_token
+                generate = False
+            elif self.refresh_expires and self.refresh_expires > valid_after:
+                try:
+                    token_data = self._client.exchange_token(self.refresh_token)
+                except HTTPError as e:
+                    if not Config._is_unauthorized(e):
+                        raise
+                    logger.warning(
+                        f"Nordigen rejected the refresh token of config {self.pk}"
+                    )
+                else:
+                    self.access_token = token_data["access"]
+                    self.access_expires = now + timedelta(
+                        seconds=token_data["access_expires"]
+                    )
+                    changed = True
+                    generate = False
+
+            if generate:
+                token_data = self._client.generate_token()
+                self.access_token = token_data["access"]
+                self.access_expires = now + timedelta(
+                    seconds=token_data["access_expires"]
+                )
+                self.refresh_token = token_data["refresh"]
+                self.refresh_expires = now + timedelta(
+                    seconds=token_data["refresh_expires"]
+                )
+                changed = True
+
+            if not self.institution_id:
+                self.institution_id = (
+                    self._client.institution.get_institution_id_by_name(
+                        country=self.country, institution=self.institution
+                    )
+                )
+                changed = True
+
+            if changed and self.pk:
+                Config.objects.filter(pk=self.pk).update(
+                    **{field: getattr(self, field) for field in self.TOKEN_FIELDS}
+                )
 
         return self._client
 
+    def _call_api(self, request):
+        """
+        Returns request(client) called with the nordigen client
+
+        When the api rejects the stored access token (the tokens were revoked
+        or replaced elsewhere) the tokens are forgotten and the call is tried
+        once more with a newly generated token pair. Safe to call from several
+        threads, the tokens are replaced only once.
+        """
+        with Config.token_lock:
+            client = self._get_client()
+            token = self.access_token
+        try:
+            return request(client)
+        except HTTPError as e:
+            if not Config._is_unauthorized(e):
+                raise
+            logger.warning(
+                f"Nordigen rejected the access token of config {self.pk}, retrying with a new one"
+            )
+        with Config.token_lock:
+            # another thread may have replaced the rejected token already
+            if self.access_token == token:
+                self._forget_tokens()
+            client = self._get_client()
+        return request(client)
+
     def create_new_requisition(self):
         """
         Create new requisition for this config
@@ -194,6 +338,12 @@ class Requisition(models.Model):
         default=False,
         verbose_name=_("Deprecated requisition"),
     )
+    last_booking_date = models.DateField(
+        blank=True,
+        null=True,
+        verbose_name=_("Latest booking date of imported transactions"),
+        help_text=_("Only transactions after this are fetched, empty fetches all"),
+    )
 
     def __str__(self):
         if self.ready:
@@ -222,18 +372,19 @@ class Requisition(models.Model):
         Initialize requisition and get the redirect url
         """
         config = self.config
-        client = config._get_client()
 
         # cannot use reverse here as url router does not know about our
         # complete-requisition-url
         complete_url = self._build_absolute_complete_url()
 
-        init = client.initialize_session(
-            institution_id=config._institution_id,
-            # redirect url after successful authentication
-            redirect_uri=complete_url,
-            # additional layer of unique ID defined by you
-            reference_id=self.nonce,
+        init = config._call_api(
+            lambda client: client.initialize_session(
+                institution_id=config.institution_id,
+                # redirect url after successful authentication
+                redirect_uri=complete_url,
+                # additional layer of unique ID defined by you
+                reference_id=self.nonce,
+            )
         )
 
         # save the data
@@ -258,6 +409,43 @@ class Requisition(models.Model):
         self.ready = True
         self.save()
 
+    def get_fetch_date_from(self, full_resync=False):
+        """
+        Date to fetch the new transactions from
+
+        Overlaps the last import by NORDIGEN_FETCH_OVERLAP_DAYS as banks can book
+        transactions late. None means the whole history that the bank gives.
+        """
+        if full_resync or not self.last_booking_date:
+            return None
+        return self.last_booking_date - timedelta(
+            days=settings_config.NORDIGEN_FETCH_OVERLAP_DAYS
+        )
+
+    def update_last_booking_date(self, transactions):
+        """
+        Move last_booking_date to the latest booked transaction
+
+        Call only after the transactions have been imported successfully
+        """
+        booking_dates = []
+        for one in transactions["transactions"]["booked"]:
+            try:
+                booking_dates.append(
+                    datetime.strptime(
+                        one.get("bookingDate") or one.get("valueDate"), "%Y-%m-%d"
+                    ).date()
+                )
+            except (TypeError, ValueError):
+                continue
+        if not booking_dates:
+            return
+        latest = max(booking_dates)
+        if self.last_booking_date and self.last_booking_date >= latest:
+            return
+        self.last_booking_date = latest
+        self.save(update_fields=["last_booking_date"])
+
     def get_transactions(self, date_from=None, date_to=None):
         """
         With valid and not deprecated requisition get transactions
@@ -273,8 +461,10 @@ class Requisition(models.Model):
             raise Exception("Requisition is not valid yet or anymore")
 
         # get all accounts
-        accounts = self.config._get_client().requisition.get_requisition_by_id(
-            requisition_id=self.requisition_id
+        accounts = self.config._call_api(
+            lambda client: client.requisition.get_requisition_by_id(
+                requisition_id=self.requisition_id
+            )
         )
 
         # convert from to to strings for api
@@ -283,13 +473,17 @@ class Requisition(models.Model):
         if date_to:
             date_to = date_to.strftime("%Y-%m-%d")
 
-        data = []
+        data = {"transactions": {"booked": [], "pending": []}}
         # get all transactions from accounts
         for account_id in accounts["accounts"]:
-            account = self.config._get_client().account_api(id=account_id)
-            transactions = account.get_transactions(
-                date_from=date_from, date_to=date_to
+            transactions = self.config._call_api(
+                lambda client: client.account_api(id=account_id).get_transactions(
+                    date_from=date_from, date_to=date_to
+                )
+            )
+            data["transactions"]["booked"] += transactions["transactions"]["booked"]
+            data["transactions"]["pending"] += transactions["transactions"].get(
+                "pending", []
             )
-            return transactions
 
         return data
@@ -1,8 +1,16 @@
 import json
-from requests.models import Response
+import threading
+import time
+from datetime import date, timedelta
+from requests.models import HTTPError, Response
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
 
+from drfx import config
+
+from users.models import BankTransaction
+from .fetcher import TransactionFetcher
 from .models import Config, Requisition
 from unittest import mock
 
@@ -272,5 +280,354 @@ class NordigenAutomationTests(TestCase):
         # and check that req is not in active manager
         self.assertNotIn(req, Requisition.active.all())
 
+    @mock.patch("requests.get", side_effect=mocked_requests_get)
+    @mock.patch("requests.post", side_effect=mocked_requests_post)
+    def test_tokens_stored(self, mock_post, mock_get):
+        """
+        Tokens and institution id are fetched only when they have expired
+        """
+
+        def called(mock_request, endpoint):
+            return sum(
+                1
+                for call in mock_request.call_args_list
+                if call.kwargs["url"].endswith(endpoint)
+            )
+
+        Config.objects.get(pk=self.config.pk)._get_client()
+        self.assertEqual(called(mock_post, "/token/new/"), 1)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.institution_id, "STRIPE_STPUIE21")
+        self.assertEqual(self.config.access_token, "string")
+
+        # new instance uses the stored ones
+        Config.objects.get(pk=self.config.pk)._get_client()
+        self.assertEqual(called(mock_post, "/token/new/"), 1)
+        self.assertEqual(called(mock_post, "/token/refresh/"), 0)
+        self.assertEqual(called(mock_get, "/institutions/?country=FI"), 1)
+
+        # expired access token is refreshed with the refresh token
+        Config.objects.filter(pk=self.config.pk).update(access_expires=timezone.now())
+        Config.objects.get(pk=self.config.pk)._get_client()
+        self.assertEqual(called(mock_post, "/token/new/"), 1)
+        self.assertEqual(called(mock_post, "/token/refresh/"), 1)
+
+        # and new pair is generated when the refresh token has expired too
+        Config.objects.filter(pk=self.config.pk).update(
+            access_expires=timezone.now(), refresh_expires=timezone.now()
+        )
+        Config.objects.get(pk=self.config.pk)._get_client()
+        self.assertEqual(called(mock_post, "/token/new/"), 2)
+
+        # changing the settings clears the stored values
+        config = Config.objects.get(pk=self.config.pk)
+        config.institution = "Wise"
+        config.save()
+        self.assertEqual(config.institution_id, "")
+        config._get_client()
+        self.assertEqual(config.institution_id, "WISE_TRWIGB22")
+        self.assertEqual(called(mock_post, "/token/new/"), 3)
+
+    @mock.patch("requests.post", side_effect=mocked_requests_post)
+    def test_rejected_token(self, mock_post):
+        """
+        Rejected stored tokens are forgotten and the call is tried once more
+        with a new token pair
+        """
+        Config.objects.filter(pk=self.config.pk).update(
+            access_token="revoked",
+            access_expires=timezone.now() + timedelta(days=1),
+            refresh_token="revoked",
+            refresh_expires=timezone.now() + timedelta(days=30),
+            institution_id="STRIPE_STPUIE21",
+        )
+
+        def unauthorized():
+            response = Response()
+            response.status_code = 401
+            response._content = b'{"detail": "Invalid token"}'
+            return response
+
+        def get(*args, **kwargs):
+            if kwargs["headers"]["Authorization"] == "Bearer revoked":
+                return unauthorized()
+            return mocked_requests_get(*args, **kwargs)
+
+        def get_accounts(client):
+            return client.requisition.get_requisition_by_id(
+                requisition_id="3fa85f64-5717-4562-b3fc-2c963f66afa6"
+            )
+
+        config = Config.objects.get(pk=self.config.pk)
+        with mock.patch("requests.get", side_effect=get):
+            accounts = config._call_api(get_accounts)
+        self.assertEqual(accounts["accounts"], ["3fa85f64-5717-4562-b3fc-2c963f66afa6"])
+        self.assertEqual(mock_post.call_count, 1)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.access_token, "string")
+        self.assertEqual(self.config.refresh_token, "string")
+
+        # the retry is done only once
+        with mock.patch(
+            "requests.get", side_effect=lambda *args, **kwargs: unauthorized()
+        ) as mock_get:
+            with self.assertRaises(HTTPError):
+                config._call_api(get_accounts)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_post.call_count, 2)
+
+    def test_last_booking_date(self):
+        """
+        Transactions are fetched from the latest imported booking date with overlap
+        """
+        req = Requisition.objects.create(
+            config=self.config,
+            ready=True,
+            valid_until=timezone.now() + timedelta(days=10),
+        )
+        # nothing imported yet, fetch everything
+        self.assertIsNone(req.get_fetch_date_from())
+
+        req.update_last_booking_date(
+            {
+                "transactions": {
+                    "booked": [
+                        {"bookingDate": "2022-10-20", "valueDate": "2022-10-19"},
+                        {"valueDate": "2022-10-21"},
+                        {"bookingDate": "date"},
+                    ],
+                    "pending": [{"valueDate": "2022-10-25"}],
+                }
+            }
+        )
+        req.refresh_from_db()
+        self.assertEqual(req.last_booking_date, date(2022, 10, 21))
+        self.assertEqual(
+            req.get_fetch_date_from(),
+            date(2022, 10, 21) - timedelta(days=config.NORDIGEN_FETCH_OVERLAP_DAYS),
+        )
+        self.assertIsNone(req.get_fetch_date_from(full_resync=True))
+
+        # fetching the overlap again does not move the date backwards
+        req.update_last_booking_date(
+            {"transactions": {"booked": [{"bookingDate": "2022-10-18"}]}}
+        )
+        req.refresh_from_db()
+        self.assertEqual(req.last_booking_date, date(2022, 10, 21))
+
     def tearDown(self):
         self.config.delete()
+
+
+def booked_transaction(transaction_id, booking_date):
+    return {
+        "transactionId": transaction_id,
+        "entryReference": "0000123",
+        "bookingDate": booking_date,
+        "valueDate": booking_date,
+        "transactionAmount": {"amount": "80.00", "currency": "EUR"},
+        "debtorName": "TESTER 1",
+        "additionalInformation": "Viitemaksu",
+    }
+
+
+class StubAccount:
+    def __init__(self, client, account_id):
+        self.client = client
+        self.account_id = account_id
+
+    def get_transactions(self, date_from=None, date_to=None):
+        client = self.client
+        with client.lock:
+            client.date_from[self.account_id] = date_from
+            client.running += 1
+            client.max_running = max(client.max_running, client.running)
+        try:
+            time.sleep(0.05)
+            booked = client.booked[self.account_id]
+            if isinstance(booked, Exception):
+                raise booked
+            return {"transactions": {"booked": booked, "pending": []}}
+        finally:
+            with client.lock:
+                client.running -= 1
+
+
+class StubRequisitionApi:
+    def __init__(self, accounts):
+        self.accounts = accounts
+
+    def get_requisition_by_id(self, requisition_id):
+        return {"accounts": self.accounts[requisition_id]}
+
+
+class StubNordigenClient:
+    """
+    Stands in for NordigenClient, records how the accounts were fetched
+    """
+
+    def __init__(self, accounts, booked):
+        self.requisition = StubRequisitionApi(accounts)
+        self.booked = booked
+        self.date_from = {}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def account_api(self, id):
+        return StubAccount(self, id)
+
+
+class TransactionFetcherTests(TestCase):
+    def setUp(self):
+        self.config = Config.objects.create(
+            api_id="testid", api_key="testkey", country="FI", institution="Stripe"
+        )
+        self.requisition = Requisition.objects.create(
+            config=self.config,
+            requisition_id="req1",
+            ready=True,
+            valid_until=timezone.now() + timedelta(days=10),
+        )
+        self.other_config = Config.objects.create(
+            api_id="testid2", api_key="testkey2", country="FI", institution="Wise"
+        )
+        self.other_requisition = Requisition.objects.create(
+            config=self.other_config,
+            requisition_id="req2",
+            ready=True,
+            valid_until=timezone.now() + timedelta(days=10),
+            last_booking_date=date(2022, 10, 20),
+        )
+        self.client = StubNordigenClient(
+            accounts={"req1": ["acc1", "acc2", "acc3"], "req2": ["acc4"]},
+            booked={
+                "acc1": [booked_transaction("TEST1", "2022-10-24")],
+                "acc2": [
+                    booked_transaction("TEST2", "2022-10-25"),
+                    booked_transaction("TEST3", "2022-10-26"),
+                ],
+                "acc3": [booked_transaction("TEST4", "2022-10-27")],
+                "acc4": [booked_transaction("TEST5", "2022-10-28")],
+            },
+        )
+
+    def _run(self, **kwargs):
+        with mock.patch.object(Config, "_get_client", return_value=self.client):
+            fetcher = TransactionFetcher(**kwargs)
+            return fetcher, fetcher.run()
+
+    def test_all_accounts_fetched_concurrently(self):
+        fetcher, results = self._run()
+
+        self.assertEqual(results["imported"], 5)
+        self.assertEqual(BankTransaction.objects.count(), 5)
+        self.assertGreater(self.client.max_running, 1)
+        self.assertLessEqual(self.client.max_running, config.NORDIGEN_FETCH_WORKERS)
+        self.assertEqual(
+            sorted(row["account_id"] for row in fetcher.accounts),
+            ["acc1", "acc2", "acc3", "acc4"],
+        )
+        self.assertTrue(all(row["seconds"] > 0 for row in fetcher.accounts))
+
+        # fetched from the last booking date with overlap
+        self.assertIsNone(self.client.date_from["acc1"])
+        self.assertEqual(
+            self.client.date_from["acc4"],
+            str(
+                date(2022, 10, 20) - timedelta(days=config.NORDIGEN_FETCH_OVERLAP_DAYS)
+            ),
+        )
+        self.requisition.refresh_from_db()
+        self.assertEqual(self.requisition.last_booking_date, date(2022, 10, 27))
+        self.other_requisition.refresh_from_db()
+        self.assertEqual(self.other_requisition.last_booking_date, date(2022, 10, 28))
+
+        # full resync ignores the stored date
+        fetcher, results = self._run(full_resync=True)
+        self.assertIsNone(self.client.date_from["acc4"])
+        self.assertEqual(results["exists"], 5)
+
+    def test_failing_account_isolated(self):
+        self.client.booked["acc2"] = Exception("Rate limit exceeded")
+        fetcher, results = self._run()
+
+        # the other accounts are imported
+        self.assertEqual(results["imported"], 3)
+        errors = {row["account_id"]: row["error"] for row in fetcher.accounts}
+        self.assertEqual(errors["acc2"], "Rate limit exceeded")
+        self.assertIsNone(errors["acc1"])
+
+        # requisition with failed account is fetched from the old date next time
+        self.requisition.refresh_from_db()
+        self.assertIsNone(self.requisition.last_booking_date)
+        self.other_requisition.refresh_from_db()
+        self.assertEqual(self.other_requisition.last_booking_date, date(2022, 10, 28))
+
+    def test_get_transactions_all_accounts(self):
+        with mock.patch.object(Config, "_get_client", return_value=self.client):
+            transactions = self.requisition.get_transactions()
+        self.assertEqual(
+            [one["transactionId"] for one in transactions["transactions"]["booked"]],
+            ["TEST1", "TEST2", "TEST3", "TEST4"],
+        )
+
+
+class TransactionFetcherTokenTests(TransactionTestCase):
+    """
+    The threads replace the token and write it to the database, so the rows
+    must be committed
+    """
+
+    def setUp(self):
+        self.config = Config.objects.create(
+            api_id="testid",
+            api_key="testkey",
+            country="FI",
+            institution="Stripe",
+            access_token="revoked",
+        )
+        self.requisition = Requisition.objects.create(
+            config=self.config,
+            requisition_id="req1",
+            ready=True,
+            valid_until=timezone.now() + timedelta(days=10),
+        )
+        accounts = {"req1": ["acc1", "acc2", "acc3"]}
+        booked = {
+            "acc1": [booked_transaction("TEST1", "2022-10-24")],
+            "acc2": [booked_transaction("TEST2", "2022-10-25")],
+            "acc3": [booked_transaction("TEST3", "2022-10-26")],
+        }
+        self.client = StubNordigenClient(accounts, booked)
+        response = Response()
+        response.status_code = 401
+        self.rejecting_client = StubNordigenClient(
+            accounts, {account: HTTPError(response=response) for account in booked}
+        )
+
+    def test_rejected_token_replaced_once(self):
+        """
+        All the accounts are fetched through Config._call_api, the token that
+        the api rejects in the threads is forgotten only once
+        """
+
+        def get_client(nordigen_config):
+            if nordigen_config.access_token == "revoked":
+                return self.rejecting_client
+            return self.client
+
+        forget_tokens = Config._forget_tokens
+        with mock.patch.object(
+            Config, "_get_client", autospec=True, side_effect=get_client
+        ), mock.patch.object(
+            Config, "_forget_tokens", autospec=True, side_effect=forget_tokens
+        ) as mock_forget:
+            fetcher = TransactionFetcher()
+            results = fetcher.run()
+
+        self.assertEqual(results["imported"], 3)
+        self.assertTrue(all(row["error"] is None for row in fetcher.accounts))
+        self.assertEqual(mock_forget.call_count, 1)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.access_token, "")
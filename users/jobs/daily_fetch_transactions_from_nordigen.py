@@ -1,16 +1,11 @@
 from django_extensions.management.jobs import DailyJob
 
-from utils.dataimport import DataImport
-from nordigenautomation.models import Requisition
+from nordigenautomation.fetcher import TransactionFetcher
 
 
 class Job(DailyJob):
     help = "Fetch transactions from Nordigen"
 
     def execute(self):
-        requisitions = Requisition.active.all()
-
-        for requisition in requisitions:
-            # fetch transactions for this requisition
-            transactions = requisition.get_transactions()
-            DataImport.import_nordigen(transactions)
+        # fetches transactions booked since the last import of each requisition
+        TransactionFetcher().run()
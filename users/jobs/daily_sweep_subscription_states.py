@@ -0,0 +1,10 @@
+from django_extensions.management.jobs import DailyJob
+
+from utils.businesslogic import BusinessLogic
+
+
+class Job(DailyJob):
+    help = "Move overdue service subscriptions to the next state"
+
+    def execute(self):
+        BusinessLogic.sweep_servicesubscription_states()
@@ -0,0 +1,10 @@
+from django_extensions.management.jobs import DailyJob
+
+from utils.businesslogic import BusinessLogic
+
+
+class Job(DailyJob):
+    help = "Update all users, imports only update the users they affect"
+
+    def execute(self):
+        BusinessLogic.update_all_users()
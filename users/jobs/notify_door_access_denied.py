@@ -0,0 +1,11 @@
+from django_extensions.management.jobs import MinutelyJob
+
+from utils.businesslogic import BusinessLogic
+
+
+class Job(MinutelyJob):
+    help = "Notify the users whose door access was denied"
+
+    def execute(self):
+        qs = BusinessLogic.find_door_access_denials()
+        BusinessLogic.notify_door_access_denied(qs)
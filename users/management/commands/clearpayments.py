@@ -38,6 +38,7 @@ class Command(BaseCommand):
             subscription.state = ServiceSubscription.OVERDUE
             subscription.paid_until = None
             subscription.last_payment = None
+            subscription.reminder_sent = None
             subscription.save()
 
         transactions = BankTransaction.objects.filter(user=user)
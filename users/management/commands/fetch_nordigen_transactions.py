@@ -1,16 +1,26 @@
 from django.core.management.base import BaseCommand
 
-from utils.dataimport import DataImport
-from nordigenautomation.models import Requisition
+from nordigenautomation.fetcher import TransactionFetcher
 
 
 class Command(BaseCommand):
     help = "Fetch new transactions from nordigen and import"
 
-    def handle(self, *args, **options):
-        requisitions = Requisition.active.all()
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full-resync",
+            action="store_true",
+            help="Fetch all the transactions the bank gives, not only the ones since the last import",
+        )
 
-        for requisition in requisitions:
-            # fetch transactions for this requisition
-            transactions = requisition.get_transactions()
-            DataImport.import_nordigen(transactions)
+    def handle(self, *args, **options):
+        fetcher = TransactionFetcher(full_resync=options["full_resync"])
+        results = fetcher.run()
+        for account in fetcher.accounts:
+            self.stdout.write(
+                f"Account {account['account_id']}: {account['booked']} transactions "
+                f"in {account['seconds']:.2f}s, error: {account['error']}"
+            )
+        self.stdout.write(
+            f"Imported {results['imported']}, existing {results['exists']}, failed {results['error']}"
+        )
@@ -8,5 +8,12 @@ from utils.businesslogic import BusinessLogic
 class Command(BaseCommand):
     help = "Updates all user info"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--per-user",
+            action="store_true",
+            help="Run updateuser for each user instead of the bulk reconciliation",
+        )
+
     def handle(self, *args, **options):
-        BusinessLogic.update_all_users()
+        BusinessLogic.update_all_users(bulk=not options["per_user"])
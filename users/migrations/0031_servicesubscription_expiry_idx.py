@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0030_alter_banktransaction_unique_together_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="servicesubscription",
+            index=models.Index(
+                fields=["service", "state", "paid_until"],
+                name="subscription_expiry_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0031_servicesubscription_expiry_idx"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="userslog",
+            index=models.Index(fields=["date"], name="userslog_date_idx"),
+        ),
+    ]
@@ -147,9 +147,10 @@ class CustomUser(AbstractUser):
         return self.email
 
     def log(self, message):
-        logevent = UsersLog.objects.create(user=self, message=message)
-        logevent.save()
-        logger.info("User {}'s log: {}".format(logevent.user, message))
+        """
+        Add a message to the user's log, written in bulk inside UsersLog.objects.deferred()
+        """
+        UsersLog.objects.add(self, message)
 
     def __str__(self):
         return self.first_name + " " + self.last_name
@@ -136,4 +136,6 @@ class MemberService(models.Model):
 
     # Returns a list of services that pay for this service
     def paid_by_services(self):
-        return MemberService.objects.filter(pays_also_service=self)
+        from users.servicegraph import ServiceGraph
+
+        return MemberService.objects.filter(id__in=ServiceGraph.get().paid_by(self.id))
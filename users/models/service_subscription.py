@@ -9,6 +9,15 @@ class ServiceSubscription(models.Model):
     Represents user subscribing to a paid service.
     """
 
+    class Meta:
+        indexes = [
+            # expiring subscriptions are looked up by service, state and paid_until
+            models.Index(
+                fields=["service", "state", "paid_until"],
+                name="subscription_expiry_idx",
+            ),
+        ]
+
     user = models.ForeignKey("CustomUser", on_delete=models.CASCADE)
     service = models.ForeignKey("MemberService", on_delete=models.CASCADE)
 
@@ -124,13 +133,22 @@ class ServiceSubscription(models.Model):
 
     # Returns a list of user's servicesubscriptions that pay for this subscription
     def paid_by_subscriptions(self):
-        paying_subs = []
-        paying_services = self.service.paid_by_services()
-        for service in paying_services:
-            subs = ServiceSubscription.objects.filter(user=self.user, service=service)
-            if subs:
-                paying_subs.append(subs[0].service.name)
-        return paying_subs
+        from users.servicegraph import ServiceGraph
+
+        graph = ServiceGraph.get()
+        paying_services = graph.paid_by(self.service_id)
+        if not paying_services:
+            return []
+        subscribed = set(
+            ServiceSubscription.objects.filter(
+                user_id=self.user_id, service__in=paying_services
+            ).values_list("service_id", flat=True)
+        )
+        return [
+            graph.services[service_id].name
+            for service_id in paying_services
+            if service_id in subscribed
+        ]
 
     def __str__(self):
         return _("Service %(servicename)s for %(username)s") % {
@@ -1,12 +1,70 @@
-from django.db import models
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
+logger = logging.getLogger(__name__)
+
+
+class UsersLogManager(models.Manager):
+    """
+    Log entries are written right away unless they are added inside `deferred()`
+    """
+
+    # entries waiting in the deferred blocks of each thread
+    _local = threading.local()
+    # how many deferred entries to write per statement
+    BATCH_SIZE = 500
+
+    def add(self, user, message):
+        """
+        Add log message for the user, see CustomUser.log
+
+        The user can also be given as its id when the user is not loaded
+        """
+        if isinstance(user, models.Model):
+            entry = self.model(user=user, message=message)
+        else:
+            entry = self.model(user_id=user, message=message)
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            entry.save()
+        else:
+            pending.append(entry)
+        logger.info("User {}'s log: {}".format(user, message))
+        return entry
+
+    @contextmanager
+    def deferred(self):
+        """
+        Collect the entries added inside the block and write them with one
+        bulk_create when it ends. Nested blocks are written by the outermost one.
+
+        Nothing is written if the block ends inside a transaction that is being
+        rolled back, the entries would be rolled back with it anyway.
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+
+        self._local.pending = []
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            if pending and not transaction.get_connection().needs_rollback:
+                self.bulk_create(pending, batch_size=self.BATCH_SIZE)
+
 
 class UsersLog(models.Model):
     """
     A text log message for user activities (status changes, payments, etc)
     """
 
+    objects = UsersLogManager()
+
     # User this log message is associated with
     user = models.ForeignKey("CustomUser", on_delete=models.CASCADE)
     date = models.DateTimeField(
@@ -20,3 +78,9 @@ class UsersLog(models.Model):
 
     def __str__(self):
         return f"{self.user} - {self.date}: {self.message}"
+
+    class Meta:
+        indexes = [
+            # the recent door access denials are looked up every minute
+            models.Index(fields=["date"], name="userslog_date_idx"),
+        ]
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from drfx import config
+
+from .models import MemberService
+
+logger = logging.getLogger(__name__)
+
+# the MemberService fields the payment logic uses
+ServiceNode = namedtuple(
+    "ServiceNode",
+    [
+        "id",
+        "name",
+        "cost",
+        "cost_min",
+        "cost_max",
+        "days_per_payment",
+        "days_bonus_for_first",
+        "days_until_suspending",
+        "pays_also_service_id",
+    ],
+)
+
+
+class ServiceGraph:
+    """
+    Read only snapshot of the member services and their pays_also_service chains
+
+    One graph is shared by the process, see ServiceGraph.get(). It is rebuilt when
+    a MemberService is saved or deleted in this process, see users/signals.py.
+    Changes made by other processes are seen after SERVICE_GRAPH_TIMEOUT seconds.
+
+    A chain that loops back to a service already in it would make the payments go
+    round forever. The edge closing the loop is left out and logged when the graph
+    is built, the services are visited in id order.
+    """
+
+    _graph = None
+    _expires = 0
+    _lock = threading.Lock()
+
+    def __init__(self, services):
+        nodes = {}
+        for service in services:
+            nodes[service.id] = ServiceNode(
+                service.id,
+                service.name,
+                service.cost,
+                service.cost_min,
+                service.cost_max,
+                service.days_per_payment,
+                service.days_bonus_for_first,
+                service.days_until_suspending,
+                service.pays_also_service_id,
+            )
+
+        pays = {}
+        paid_by = {}
+        cycles = []
+        for node in sorted(nodes.values()):
+            target = node.pays_also_service_id
+            if target is None or target not in nodes:
+                continue
+            # follow the chain from the target, out of it is back here
+            chain = [node.id, target]
+            while chain[-1] != node.id and chain[-1] in pays:
+                chain.append(pays[chain[-1]])
+            if chain[-1] == node.id:
+                logger.error(
+                    f"Member services pay for each other in a loop {chain}, "
+                    f"ignoring that {node.name} pays also {nodes[target].name}"
+                )
+                cycles.append(tuple(chain))
+                continue
+            pays[node.id] = target
+            paid_by.setdefault(target, []).append(node.id)
+
+        self.services = MappingProxyType(nodes)
+        self._pays = MappingProxyType(pays)
+        self._paid_by = MappingProxyType(
+            {service_id: tuple(ids) for service_id, ids in paid_by.items()}
+        )
+        self.cycles = tuple(cycles)
+
+    def pays_also(self, service_id):
+        """
+        Id of the service this service also pays for or None
+        """
+        return self._pays.get(service_id)
+
+    def paid_by(self, service_id):
+        """
+        Ids of the services that also pay for this service
+        """
+        return self._paid_by.get(service_id, ())
+
+    @staticmethod
+    def get():
+        now = time.monotonic()
+        graph = ServiceGraph._graph
+        if graph is not None and ServiceGraph._expires > now:
+            return graph
+        with ServiceGraph._lock:
+            if ServiceGraph._graph is None or ServiceGraph._expires <= now:
+                ServiceGraph._graph = ServiceGraph(MemberService.objects.all())
+                ServiceGraph._expires = now + config.SERVICE_GRAPH_TIMEOUT
+            return ServiceGraph._graph
+
+    @staticmethod
+    def clear():
+        with ServiceGraph._lock:
+            ServiceGraph._graph = None
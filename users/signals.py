@@ -2,13 +2,17 @@ import logging
 from drfx import config
 from django.contrib.auth.forms import PasswordResetForm
 from django.core.mail import send_mail
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import Signal, receiver
 from django.template.loader import render_to_string
 from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 from utils import referencenumber
+import mailer
 from . import models
+from .servicegraph import ServiceGraph
 
 from django.contrib.sites.models import Site
 
@@ -27,6 +31,12 @@ deactivate_user = Signal()
 #
 create_user = Signal()
 #
+# Signal for other modules when service subscriptions were changed without
+# saving them one by one (bulk updates do not send post_save)
+# subscriptions is the list of changed subscriptions
+#
+subscriptions_changed = Signal()
+#
 # Signal for other modules to handle new membership applications
 #
 create_application = Signal()
@@ -72,6 +82,17 @@ def service_subscription_create(
             )
 
 
+@receiver(post_save, sender=models.MemberService)
+@receiver(post_delete, sender=models.MemberService)
+def member_service_changed(sender, **kwargs):
+    """
+    Rebuild the service graph, again after commit so that a graph built in
+    between does not keep the old services
+    """
+    ServiceGraph.clear()
+    transaction.on_commit(ServiceGraph.clear)
+
+
 @receiver(create_user)
 def send_reset_password_email(sender, instance: models.CustomUser, **kwargs):
     """
@@ -305,20 +326,31 @@ def handle_marked_for_deletion(sender, instance: models.CustomUser, raw, **kwarg
 # instance is the user object (this signal will only trigger if the user was
 # succesfully identified)
 # method is the method that was tried (phone, nfc etc)
+# The signal is sent outside the access request by the notify_door_access_denied
+# job, at most once in DOOR_ACCESS_DENIED_NOTIFY_INTERVAL seconds for each user
 door_access_denied = Signal()
 
+# UsersLog messages of the denied door accesses and of the notifications sent
+# about them, see BusinessLogic.find_door_access_denials
+DOOR_ACCESS_DENIED = "Door access denied with {}"
+DOOR_ACCESS_DENIED_NOTIFIED = "Door access denied notification sent"
+
 
 @receiver(door_access_denied)
 def notify_user_door_access_denied(sender, user: models.CustomUser, method, **kwargs):
+    """
+    Queue a mail telling the user why the door did not open
+    """
+    prefetch_related_objects([user], "servicesubscription_set__service")
     context = {
         "user": user,
         "method": method,
         "config": config,
         "site": Site.objects.get_current(),
     }
-    translation.activate(user.language)
-    subject = _("Door access denied")
-    from_email = config.NOREPLY_FROM_ADDRESS
-    to = [user.email]
-    plaintext_content = render_to_string("mail/door_access_denied.txt", context)
-    send_mail(subject, plaintext_content, from_email, to, fail_silently=True)
+    with translation.override(user.language):
+        subject = _("Door access denied")
+        plaintext_content = render_to_string("mail/door_access_denied.txt", context)
+    mailer.send_mail(
+        subject, plaintext_content, config.NOREPLY_FROM_ADDRESS, [user.email]
+    )
@@ -1,9 +1,15 @@
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from drfx import config
 from datetime import date, timedelta
+from users.servicegraph import ServiceGraph
 from utils import referencenumber
+from utils.bulkreconciler import BulkReconciler
 from utils.businesslogic import BusinessLogic
 
 from users.models import (
@@ -12,6 +18,7 @@ from users.models import (
     CustomUser,
     MemberService,
     ServiceSubscription,
+    UsersLog,
 )
 
 
@@ -248,3 +255,440 @@ class PaymentServices(TestCase):
         MemberService.objects.all().delete()
         ServiceSubscription.objects.all().delete()
         BankTransaction.objects.all().delete()
+
+
+class BulkReconcilerTests(TestCase):
+    """
+    BulkReconciler must give exactly the same results as updateuser
+    """
+
+    def setUp(self):
+        self.membership = MemberService.objects.create(
+            name="membership", cost=20, days_per_payment=365, days_bonus_for_first=30
+        )
+        self.access = MemberService.objects.create(
+            name="access",
+            cost=35,
+            cost_min=10,
+            days_per_payment=31,
+            days_bonus_for_first=14,
+            days_until_suspending=30,
+            pays_also_service=self.membership,
+        )
+        today = date.today()
+
+        # new member paying access for the first time, which also pays membership
+        user = self._user("new")
+        access = self._subscription(user, self.access, 1)
+        self._subscription(user, self.membership, 2)
+        self._transaction(access, 35, today - timedelta(days=3))
+        self._transaction(access, 5, today - timedelta(days=2))
+
+        # lapsed member, both services have gone overdue and access pays both again
+        user = self._user("lapsed")
+        access = self._subscription(
+            user, self.access, 3, ServiceSubscription.ACTIVE, today - timedelta(days=5)
+        )
+        self._subscription(
+            user,
+            self.membership,
+            4,
+            ServiceSubscription.ACTIVE,
+            today - timedelta(days=5),
+        )
+        self._transaction(access, 35, today - timedelta(days=1))
+
+        # member paying only membership with a too small payment and one good one
+        user = self._user("membership")
+        membership = self._subscription(user, self.membership, 5)
+        self._transaction(membership, 10, today - timedelta(days=10))
+        self._transaction(membership, 20, today - timedelta(days=9))
+
+        # member who has been overdue so long that access gets suspended
+        user = self._user("suspended")
+        self._subscription(
+            user,
+            self.access,
+            6,
+            ServiceSubscription.OVERDUE,
+            today - timedelta(days=40),
+        )
+
+        # member paying with custom invoices, one too small and one ok
+        user = self._user("invoice")
+        access = self._subscription(
+            user, self.access, 7, ServiceSubscription.OVERDUE, today - timedelta(days=2)
+        )
+        self._subscription(
+            user,
+            self.membership,
+            8,
+            ServiceSubscription.ACTIVE,
+            today + timedelta(days=100),
+        )
+        small = CustomInvoice.objects.create(
+            user=user, subscription=access, days=60, amount=100
+        )
+        ok = CustomInvoice.objects.create(
+            user=user, subscription=access, days=90, amount=60
+        )
+        self._transaction(small, 50, today - timedelta(days=1))
+        self._transaction(ok, 60, today - timedelta(days=1))
+
+    def _user(self, name):
+        return get_user_model().objects.create_customuser(
+            first_name=name,
+            last_name="LastName",
+            email=f"{name}@example.com",
+            birthday=date.today(),
+            municipality="City",
+            nick=name,
+            phone=f"+358{len(name)}{CustomUser.objects.count()}",
+        )
+
+    def _subscription(
+        self, user, service, refbase, state=ServiceSubscription.OVERDUE, paid_until=None
+    ):
+        return ServiceSubscription.objects.create(
+            user=user,
+            service=service,
+            state=state,
+            paid_until=paid_until,
+            reference_number=referencenumber.generate(1000 + refbase),
+        )
+
+    def _transaction(self, target, amount, day):
+        return BankTransaction.objects.create(
+            reference_number=target.reference_number,
+            archival_reference=f"{target.reference_number}-{BankTransaction.objects.count()}",
+            date=day,
+            amount=amount,
+        )
+
+    @staticmethod
+    def _snapshot():
+        return {
+            "subscriptions": list(
+                ServiceSubscription.objects.order_by("pk").values_list(
+                    "pk", "state", "paid_until", "last_payment"
+                )
+            ),
+            "transactions": list(
+                BankTransaction.objects.order_by("pk").values_list(
+                    "pk", "user", "comment", "has_been_used"
+                )
+            ),
+            "invoices": list(
+                CustomInvoice.objects.order_by("pk").values_list(
+                    "pk", "payment_transaction"
+                )
+            ),
+            "logs": list(
+                UsersLog.objects.order_by("pk").values_list("user", "message")
+            ),
+        }
+
+    def test_same_results_as_updateuser(self):
+        with transaction.atomic():
+            BusinessLogic.update_all_users(bulk=False)
+            expected = self._snapshot()
+            transaction.set_rollback(True)
+
+        BusinessLogic.update_all_users()
+        self.maxDiff = None
+        self.assertEqual(expected, self._snapshot())
+
+        # and running again changes nothing
+        BusinessLogic.update_all_users()
+        self.assertEqual(expected, self._snapshot())
+
+    def test_user_subset(self):
+        user = CustomUser.objects.get(first_name="lapsed")
+        BulkReconciler(users=[user]).run()
+        self.assertFalse(
+            ServiceSubscription.objects.exclude(user=user)
+            .filter(last_payment__isnull=False)
+            .exists()
+        )
+        self.assertEqual(
+            ServiceSubscription.objects.filter(
+                user=user, paid_until__gt=date.today()
+            ).count(),
+            2,
+        )
+
+    def test_constant_queries(self):
+        ServiceGraph.clear()
+        reconciler = BulkReconciler()
+        with CaptureQueriesContext(connection) as few_users:
+            reconciler._load()
+
+        for i in range(10):
+            user = self._user(f"extra{i}")
+            subscription = self._subscription(user, self.access, 100 + i)
+            self._transaction(subscription, 35, date.today())
+
+        ServiceGraph.clear()
+        reconciler = BulkReconciler()
+        with CaptureQueriesContext(connection) as many_users:
+            reconciler._load()
+        self.assertEqual(len(few_users), len(many_users))
+
+
+class StateSweepTests(TestCase):
+    """
+    sweep_servicesubscription_states must give the same states as
+    _check_servicesubscription_state
+    """
+
+    def setUp(self):
+        self.membership = MemberService.objects.create(
+            name="membership", cost=20, days_per_payment=365
+        )
+        self.access = MemberService.objects.create(
+            name="access", cost=35, days_per_payment=31, days_until_suspending=30
+        )
+        today = date.today()
+        cases = [
+            (self.access, ServiceSubscription.ACTIVE, today + timedelta(days=1)),
+            (self.access, ServiceSubscription.ACTIVE, today),
+            (self.access, ServiceSubscription.ACTIVE, today - timedelta(days=1)),
+            (self.access, ServiceSubscription.ACTIVE, today - timedelta(days=40)),
+            (self.access, ServiceSubscription.OVERDUE, today - timedelta(days=30)),
+            (self.access, ServiceSubscription.OVERDUE, today - timedelta(days=31)),
+            (self.access, ServiceSubscription.OVERDUE, today + timedelta(days=3)),
+            (self.access, ServiceSubscription.SUSPENDED, today - timedelta(days=40)),
+            (self.access, ServiceSubscription.ACTIVE, None),
+            (self.membership, ServiceSubscription.ACTIVE, today - timedelta(days=40)),
+            (self.membership, ServiceSubscription.OVERDUE, today - timedelta(days=400)),
+        ]
+        for index, (service, state, paid_until) in enumerate(cases):
+            user = get_user_model().objects.create_customuser(
+                first_name=f"user{index}",
+                last_name="LastName",
+                email=f"user{index}@example.com",
+                birthday=date.today(),
+                municipality="City",
+                nick=f"user{index}",
+                phone=f"+35840{index}",
+            )
+            ServiceSubscription.objects.create(
+                user=user,
+                service=service,
+                state=state,
+                paid_until=paid_until,
+                reminder_sent=today,
+            )
+
+    @staticmethod
+    def _states():
+        return list(
+            ServiceSubscription.objects.order_by("id").values_list(
+                "id", "state", "reminder_sent"
+            )
+        )
+
+    def test_same_results_as_check(self):
+        with transaction.atomic():
+            for subscription in ServiceSubscription.objects.all():
+                BusinessLogic._check_servicesubscription_state(subscription)
+            expected = self._states()
+            transaction.set_rollback(True)
+
+        with transaction.atomic():
+            BulkReconciler().run()
+            self.assertEqual(expected, self._states())
+            transaction.set_rollback(True)
+
+        before = {id: state for id, state, reminder_sent in self._states()}
+        UsersLog.objects.all().delete()
+        changed = BusinessLogic.sweep_servicesubscription_states()
+        self.assertEqual(expected, self._states())
+        self.assertEqual(
+            {subscription.id for subscription in changed},
+            {id for id, state, reminder_sent in expected if before[id] != state},
+        )
+        # the expiry reminder is cleared when the state changes
+        for id, state, reminder_sent in expected:
+            self.assertEqual(reminder_sent is None, before[id] != state)
+        # active to suspended goes through overdue and is logged twice
+        self.assertEqual(UsersLog.objects.count(), len(changed) + 1)
+
+        # and running again changes nothing
+        self.assertEqual(BusinessLogic.sweep_servicesubscription_states(), [])
+        self.assertEqual(expected, self._states())
+
+    def test_constant_queries(self):
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as few:
+                BusinessLogic.sweep_servicesubscription_states()
+            transaction.set_rollback(True)
+
+        for subscription in ServiceSubscription.objects.filter(
+            service=self.access, state=ServiceSubscription.ACTIVE
+        ):
+            for i in range(5):
+                ServiceSubscription.objects.create(
+                    user=subscription.user,
+                    service=self.access,
+                    state=subscription.state,
+                    paid_until=subscription.paid_until,
+                )
+
+        with CaptureQueriesContext(connection) as many:
+            BusinessLogic.sweep_servicesubscription_states()
+        self.assertEqual(len(few), len(many))
+
+    def test_lock_without_select_for_update_of(self):
+        """
+        MariaDB can lock the rows but not only the rows of some of the tables
+        """
+        locked = []
+
+        def for_update_sql(nowait=False, skip_locked=False, of=(), no_key=False):
+            locked.append(tuple(of))
+            # sqlite does not understand FOR UPDATE
+            return ""
+
+        for has_of in [False, True]:
+            locked.clear()
+            with mock.patch.multiple(
+                connection.features,
+                has_select_for_update=True,
+                has_select_for_update_of=has_of,
+            ), mock.patch.object(connection.ops, "for_update_sql", for_update_sql):
+                with transaction.atomic():
+                    changed = BusinessLogic.sweep_servicesubscription_states()
+                    transaction.set_rollback(True)
+            self.assertTrue(changed)
+            self.assertTrue(locked)
+            # the subscription rows only when the database can do it
+            self.assertEqual(any(locked), has_of)
+
+
+class ServiceGraphTests(TestCase):
+    def setUp(self):
+        self.membership = MemberService.objects.create(
+            name="membership", cost=20, days_per_payment=365
+        )
+        self.access = MemberService.objects.create(
+            name="access",
+            cost=35,
+            days_per_payment=31,
+            pays_also_service=self.membership,
+        )
+        self.storage = MemberService.objects.create(
+            name="storage",
+            cost=10,
+            days_per_payment=31,
+            pays_also_service=self.membership,
+        )
+
+    def test_edges(self):
+        graph = ServiceGraph.get()
+        self.assertEqual(graph.pays_also(self.access.id), self.membership.id)
+        self.assertIsNone(graph.pays_also(self.membership.id))
+        self.assertEqual(
+            graph.paid_by(self.membership.id), (self.access.id, self.storage.id)
+        )
+        self.assertEqual(graph.paid_by(self.access.id), ())
+        self.assertEqual(graph.services[self.access.id].cost, 35)
+        self.assertEqual(graph.cycles, ())
+
+    def test_cached(self):
+        graph = ServiceGraph.get()
+        with self.assertNumQueries(0):
+            self.assertIs(ServiceGraph.get(), graph)
+
+        # saving a service rebuilds the graph
+        self.storage.pays_also_service = None
+        self.storage.save()
+        self.assertEqual(
+            ServiceGraph.get().paid_by(self.membership.id), (self.access.id,)
+        )
+
+    def test_cycle(self):
+        self.membership.pays_also_service = self.access
+        self.membership.save()
+        graph = ServiceGraph.get()
+        # the edge closing the loop is left out
+        self.assertEqual(
+            graph.cycles, ((self.access.id, self.membership.id, self.access.id),)
+        )
+        self.assertEqual(graph.pays_also(self.membership.id), self.access.id)
+        self.assertIsNone(graph.pays_also(self.access.id))
+
+        # and paying does not go round forever
+        user = get_user_model().objects.create_customuser(
+            first_name="FirstName",
+            last_name="LastName",
+            email="user1@example.com",
+            birthday=date.today(),
+            municipality="City",
+            nick="user1",
+            phone="+358123123",
+        )
+        access = ServiceSubscription.objects.create(
+            user=user,
+            service=self.access,
+            state=ServiceSubscription.OVERDUE,
+            reference_number=referencenumber.generate(1001),
+        )
+        membership = ServiceSubscription.objects.create(
+            user=user,
+            service=self.membership,
+            state=ServiceSubscription.OVERDUE,
+            reference_number=referencenumber.generate(1002),
+        )
+        BankTransaction.objects.create(
+            reference_number=membership.reference_number,
+            archival_reference="1",
+            date=date.today(),
+            amount=20,
+        )
+        BusinessLogic.updateuser(user)
+        access.refresh_from_db()
+        self.assertEqual(access.state, ServiceSubscription.ACTIVE)
+
+    def test_payments_read_graph(self):
+        """
+        The costs and days of the services come from the graph, a change that has
+        not reached it yet is not seen by either payment logic
+        """
+        ServiceGraph.get()
+        MemberService.objects.filter(pk=self.access.pk).update(
+            cost=100, days_per_payment=1
+        )
+
+        subscriptions = []
+        for i, update in enumerate(
+            [BusinessLogic.updateuser, lambda user: BulkReconciler([user]).run()]
+        ):
+            user = get_user_model().objects.create_customuser(
+                first_name="FirstName",
+                last_name="LastName",
+                email=f"user{i}@example.com",
+                birthday=date.today(),
+                municipality="City",
+                nick=f"user{i}",
+                phone=f"+35812312{i}",
+            )
+            subscription = ServiceSubscription.objects.create(
+                user=user,
+                service=self.access,
+                state=ServiceSubscription.OVERDUE,
+                reference_number=referencenumber.generate(2000 + i),
+            )
+            BankTransaction.objects.create(
+                reference_number=subscription.reference_number,
+                archival_reference=str(i),
+                date=date.today(),
+                amount=35,
+            )
+            update(user)
+            subscription.refresh_from_db()
+            subscriptions.append(subscription)
+
+        for subscription in subscriptions:
+            self.assertEqual(subscription.state, ServiceSubscription.ACTIVE)
+            self.assertEqual(subscription.paid_until, date.today() + timedelta(days=31))
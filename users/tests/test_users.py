@@ -3,6 +3,7 @@ from datetime import timedelta
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.dispatch import receiver
 from django.test import TestCase
@@ -114,7 +115,12 @@ class TestBusinessLogicSubscriptionExpiries(TestCase):
 
     def test_find(self):
         about_to_expire = BusinessLogic.find_expiring_service_subscriptions()
-        self.assertEqual(len(about_to_expire), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(about_to_expire), 3)
+            # related objects are loaded with the subscriptions
+            for ss in about_to_expire:
+                self.assertTrue(ss.user.email and ss.service.name)
+
         self.assertEqual(
             list(about_to_expire),
             [
@@ -172,6 +178,53 @@ class TestExpiryNotificationEmail(TestCase):
         self.assertIn(self.servicesubscription.service.name, message.email.body)
         self.assertIn(str(self.servicesubscription.paid_until.year), message.email.body)
 
+        # logged and marked as reminded
+        self.assertEqual(
+            models.UsersLog.objects.filter(
+                user=self.user, message__startswith="Expiry email notification sent"
+            ).count(),
+            1,
+        )
+        self.servicesubscription.refresh_from_db()
+        self.assertEqual(self.servicesubscription.reminder_sent, timezone.now().date())
+
+        # running again on the same day sends nothing
+        about_to_expire = BusinessLogic.find_expiring_service_subscriptions()
+        self.assertEqual(len(about_to_expire), 0)
+        BusinessLogic.notify_expiring_service_subscriptions(
+            models.ServiceSubscription.objects.all()
+        )
+        self.assertEqual(len(Message.objects.all()), 1)
+
+    def test_send_expiry_notification_languages(self):
+        user2 = get_user_model().objects.create_customuser(
+            first_name="Second",
+            last_name="LastName",
+            email="user2@example.com",
+            birthday=timezone.now(),
+            municipality="City",
+            nick="user2",
+            phone="+358123124",
+        )
+        user2.language = "en"
+        user2.save()
+        models.ServiceSubscription.objects.create(
+            user=user2,
+            service=self.memberservice,
+            state=models.ServiceSubscription.ACTIVE,
+            paid_until=timezone.now().date() + timedelta(days=2),
+        )
+
+        BusinessLogic.notify_expiring_service_subscriptions(
+            BusinessLogic.find_expiring_service_subscriptions()
+        )
+
+        bodies = {
+            message.email.to[0]: message.email.body for message in Message.objects.all()
+        }
+        self.assertIn(f"Hei {self.user.first_name}", bodies[self.user.email])
+        self.assertIn(f"Hi {user2.first_name}", bodies[user2.email])
+
     def tearDown(self):
         models.MemberService.objects.all().delete()
         models.ServiceSubscription.objects.all().delete()
@@ -252,6 +305,57 @@ class TestNewApplicationHappyPathEmails(TestCase):
         self.assertIn(config.MEMBERS_GUIDE_URL, mail.outbox[0].body, "wikiurl")
 
 
+class UsersLogTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_customuser(
+            first_name="FirstName",
+            last_name="LastName",
+            email="user1@example.com",
+            birthday=timezone.now(),
+            municipality="City",
+            nick="user1",
+            phone="+358123123",
+        )
+        models.UsersLog.objects.all().delete()
+
+    def test_log(self):
+        with self.assertNumQueries(1):
+            self.user.log("first")
+        self.assertEqual(models.UsersLog.objects.get().message, "first")
+
+    def test_add_user_id(self):
+        # the api logs with the user id only
+        with self.assertNumQueries(1):
+            models.UsersLog.objects.add(self.user.id, "first")
+        self.assertEqual(models.UsersLog.objects.get().user, self.user)
+
+    def test_deferred(self):
+        with self.assertNumQueries(1):
+            with models.UsersLog.objects.deferred():
+                self.user.log("first")
+                with models.UsersLog.objects.deferred():
+                    self.user.log("second")
+                # nested block does not write
+                self.user.log("third")
+        self.assertEqual(
+            list(
+                models.UsersLog.objects.order_by("id").values_list("message", flat=True)
+            ),
+            ["first", "second", "third"],
+        )
+
+        # written right away again
+        self.user.log("fourth")
+        self.assertEqual(models.UsersLog.objects.count(), 4)
+
+    def test_deferred_rollback(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic(), models.UsersLog.objects.deferred():
+                self.user.log("first")
+                get_user_model().objects.create(email=self.user.email)
+        self.assertFalse(models.UsersLog.objects.exists())
+
+
 class ServiceSubscriptionTests(TestCase):
     def setUp(self):
         # one active user, one inactive user
@@ -0,0 +1,413 @@
+import logging
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.db.models import Q
+from django.db.transaction import atomic
+from django.utils import timezone, translation
+from django.utils.translation import gettext as _
+
+from users.models import (
+    BankTransaction,
+    CustomInvoice,
+    CustomUser,
+    ServiceSubscription,
+    UsersLog,
+)
+from users.servicegraph import ServiceGraph
+from users.signals import subscriptions_changed
+
+logger = logging.getLogger(__name__)
+
+
+class BulkReconciler:
+    """
+    Set based version of BusinessLogic.updateuser for many users at once.
+
+    Users, their subscriptions and open custom invoices and the unused bank
+    transactions matching their reference numbers are loaded in a handful of
+    queries, the costs and days of the member services come from ServiceGraph.
+    The payment rules of BusinessLogic are then applied in memory, user by user
+    in the same order as updateuser would apply them, and the results are
+    written back with bulk_update and bulk_create.
+
+    Keep the rules here in sync with BusinessLogic, the tests in
+    users/tests/test_payments.py compare the results of both.
+    """
+
+    # how many rows to write per statement
+    BATCH_SIZE = 500
+
+    def __init__(self, users=None):
+        """
+        users can be a queryset or a list of users to reconcile, default is everyone
+        """
+        self.users = users
+
+        self.dirty_transactions = {}
+        self.dirty_subscriptions = {}
+        self.dirty_invoices = {}
+        self.logs = []
+        # (subscription, oldstate, newstate) for every state change made
+        self.state_changes = []
+
+    def run(self):
+        """
+        Reconcile all the users and save the results
+        """
+        self._load()
+        for user in self.userlist:
+            self._update_user(user)
+        self._save()
+        return self
+
+    def _load(self):
+        """
+        Load everything needed for the reconciliation with a constant number of queries
+        """
+        users = self.users
+        if users is None:
+            users = CustomUser.objects.all()
+        self.userlist = list(users)
+        self.users_by_id = {user.id: user for user in self.userlist}
+
+        # the costs and days of the services and the pays_also_service edges
+        # without loops
+        self.graph = ServiceGraph.get()
+
+        subscriptions = ServiceSubscription.objects.order_by("pk")
+        invoices = CustomInvoice.objects.filter(
+            payment_transaction__isnull=True
+        ).order_by("pk")
+        if self.users is not None:
+            subscriptions = subscriptions.filter(user__in=list(self.users_by_id))
+            invoices = invoices.filter(user__in=list(self.users_by_id))
+
+        self.subscriptions_by_id = {}
+        self.subscriptions_by_user = defaultdict(list)
+        for subscription in subscriptions.select_related("service"):
+            subscription.user = self.users_by_id[subscription.user_id]
+            self.subscriptions_by_id[subscription.id] = subscription
+            self.subscriptions_by_user[subscription.user_id].append(subscription)
+
+        self.invoices_by_user = defaultdict(list)
+        self.invoices_by_reference = defaultdict(list)
+        for invoice in invoices.select_related("subscription__service"):
+            invoice.user = self.users_by_id[invoice.user_id]
+            if invoice.subscription_id in self.subscriptions_by_id:
+                invoice.subscription = self.subscriptions_by_id[invoice.subscription_id]
+            self.invoices_by_user[invoice.user_id].append(invoice)
+            self.invoices_by_reference[invoice.reference_number].append(invoice)
+
+        # only unused transactions with a reference that we could be interested in
+        transactions = (
+            BankTransaction.objects.filter(has_been_used=False)
+            .filter(
+                Q(reference_number__in=subscriptions.values("reference_number"))
+                | Q(reference_number__in=invoices.values("reference_number"))
+            )
+            .select_related("user")
+            .order_by("pk")
+        )
+        self.transactions_by_reference = defaultdict(list)
+        for transaction in transactions:
+            if transaction.user_id in self.users_by_id:
+                transaction.user = self.users_by_id[transaction.user_id]
+            self.transactions_by_reference[transaction.reference_number].append(
+                transaction
+            )
+
+    def _save(self):
+        """
+        Write all the changes in one database transaction
+        """
+        with atomic():
+            BankTransaction.objects.bulk_update(
+                self.dirty_transactions.values(),
+                ["user", "comment", "has_been_used"],
+                batch_size=self.BATCH_SIZE,
+            )
+            ServiceSubscription.objects.bulk_update(
+                self.dirty_subscriptions.values(),
+                ["state", "paid_until", "last_payment", "reminder_sent"],
+                batch_size=self.BATCH_SIZE,
+            )
+            CustomInvoice.objects.bulk_update(
+                self.dirty_invoices.values(),
+                ["payment_transaction", "last_modified"],
+                batch_size=self.BATCH_SIZE,
+            )
+            with UsersLog.objects.deferred():
+                for user, message in self.logs:
+                    user.log(message)
+
+        if self.dirty_subscriptions:
+            subscriptions_changed.send(
+                ServiceSubscription,
+                subscriptions=list(self.dirty_subscriptions.values()),
+            )
+
+        logger.info(
+            f"Reconciled {len(self.userlist)} users: "
+            f"{len(self.dirty_transactions)} transactions, "
+            f"{len(self.dirty_subscriptions)} subscriptions, "
+            f"{len(self.dirty_invoices)} invoices and {len(self.logs)} log entries changed"
+        )
+
+    def _log(self, user, message):
+        """
+        Same as CustomUser.log but the entry is added when saving
+        """
+        self.logs.append((user, message))
+
+    def _unused_transactions(self, reference_number):
+        return [
+            transaction
+            for transaction in self.transactions_by_reference.get(reference_number, [])
+            if not transaction.has_been_used
+        ]
+
+    def _update_user(self, user):
+        """
+        See BusinessLogic.updateuser
+        """
+        for invoice in self.invoices_by_user[user.id]:
+            transactions = self._unused_transactions(invoice.reference_number)
+            if len(transactions) > 1:
+                logger.warn(
+                    "Suspicious: more than one transaction matching custominvoice reference!"
+                )
+
+            for transaction in transactions:
+                self._check_transaction_pays_custominvoice(transaction)
+
+        servicesubscriptions = self.subscriptions_by_user[user.id]
+        for subscription in servicesubscriptions:
+            self._update_subscription(user, subscription, servicesubscriptions)
+            self._check_servicesubscription_state(subscription)
+
+    def _check_transaction_pays_custominvoice(self, transaction):
+        """
+        See BusinessLogic._check_transaction_pays_custominvoice
+        """
+        invoices = [
+            invoice
+            for invoice in self.invoices_by_reference.get(
+                transaction.reference_number, []
+            )
+            if invoice.payment_transaction_id is None
+        ]
+
+        for invoice in invoices:
+            if transaction.amount >= invoice.amount:
+                subscription = self.subscriptions_by_id.get(invoice.subscription_id)
+                if subscription is None or subscription.user_id != invoice.user_id:
+                    raise ServiceSubscription.DoesNotExist(
+                        f"No subscription {invoice.subscription_id} for {invoice.user}"
+                    )
+                self._service_paid_by_transaction(
+                    subscription, transaction, invoice.days
+                )
+                invoice.payment_transaction = transaction
+                invoice.last_modified = timezone.now()
+                self.dirty_invoices[invoice.id] = invoice
+            else:
+                transaction.comment = f"Insufficient amount for invoice {invoice}"
+                self.dirty_transactions[transaction.id] = transaction
+                logger.debug(
+                    f"Transaction {transaction} insufficient for invoice {invoice}"
+                )
+
+    def _update_subscription(self, user, subscription, servicesubscriptions):
+        """
+        See BusinessLogic._updatesubscription
+        """
+        logger.debug(f"Updating {subscription} for {user}")
+        translation.activate(user.language)
+
+        if subscription.state == ServiceSubscription.SUSPENDED:
+            logger.debug("Service is suspended - no action")
+            return
+
+        if not subscription.reference_number:
+            logger.debug("Service has no reference number - no action")
+            return
+
+        subscribed_service_ids = {ss.service_id for ss in servicesubscriptions}
+        for service_id in self.graph.paid_by(subscription.service_id):
+            if service_id in subscribed_service_ids:
+                logger.debug(
+                    f"Service is paid by {self.graph.services[service_id].name} which user is subscribed so skipping this service."
+                )
+                return
+
+        transactions = sorted(
+            self._unused_transactions(subscription.reference_number),
+            key=lambda transaction: (transaction.date, transaction.id),
+        )
+        service = self.graph.services[subscription.service_id]
+        for transaction in transactions:
+            if self._transaction_pays_service(transaction, service):
+                logger.debug(
+                    f"Transaction is new and pays for service {subscription.service}"
+                )
+                self._service_paid_by_transaction(
+                    subscription, transaction, service.days_per_payment
+                )
+            else:
+                transaction.user = subscription.user
+                transaction.comment = (
+                    f"Amount insufficient to pay service {subscription.service}"
+                )
+                self.dirty_transactions[transaction.id] = transaction
+                logger.debug(f"Transaction does not pay service {subscription.service}")
+
+    @staticmethod
+    def _transaction_pays_service(transaction, service):
+        """
+        See BusinessLogic._transaction_pays_service
+        """
+        if service.cost_min and transaction.amount < service.cost_min:
+            return False
+        if not service.cost_min and transaction.amount < service.cost:
+            return False
+        return True
+
+    def _check_servicesubscription_state(self, subscription):
+        """
+        See BusinessLogic._check_servicesubscription_state
+        """
+        if subscription.state == ServiceSubscription.SUSPENDED:
+            return
+
+        oldstate = subscription.state
+        service = self.graph.services[subscription.service_id]
+
+        if (
+            subscription.state == ServiceSubscription.OVERDUE
+            and subscription.paid_until
+            and subscription.paid_until > date.today()
+        ):
+            self._set_state(subscription, oldstate, ServiceSubscription.ACTIVE)
+
+        if (
+            subscription.state == ServiceSubscription.ACTIVE
+            and subscription.paid_until
+            and subscription.paid_until < date.today()
+        ):
+            logger.debug(f"{subscription} payment overdue so changing state to OVERDUE")
+            self._set_state(subscription, oldstate, ServiceSubscription.OVERDUE)
+
+        if (
+            subscription.state == ServiceSubscription.OVERDUE
+            and service.days_until_suspending
+            and subscription.days_overdue() > service.days_until_suspending
+        ):
+            logger.debug(
+                f"{subscription} has been overdue for {subscription.days_overdue()} days - suspending"
+            )
+            self._set_state(subscription, oldstate, ServiceSubscription.SUSPENDED)
+
+    def _set_state(self, subscription, oldstate, newstate):
+        """
+        See BusinessLogic._servicesubscription_state_changed
+        """
+        subscription.state = newstate
+        subscription.reminder_sent = None
+        self.dirty_subscriptions[subscription.id] = subscription
+        self.state_changes.append((subscription, oldstate, newstate))
+
+        translation.activate(subscription.user.language)
+        self._log(
+            subscription.user,
+            _("Service %(servicename)s state changed from %(oldstate)s to %(newstate)s")
+            % {
+                "servicename": subscription.service.name,
+                "oldstate": oldstate,
+                "newstate": newstate,
+            },
+        )
+
+    def _service_paid_by_transaction(self, servicesubscription, transaction, add_days):
+        """
+        See BusinessLogic._service_paid_by_transaction
+        """
+        translation.activate(servicesubscription.user.language)
+
+        logger.debug(f"Paying {servicesubscription} and gained {add_days} days more")
+        service = self.graph.services[servicesubscription.service_id]
+
+        days_to_add = timedelta(days=add_days)
+        if not servicesubscription.paid_until:
+            bonus_days = timedelta(days=service.days_bonus_for_first)
+            logger.debug(
+                f"{servicesubscription} paid for first time, adding bonus of {bonus_days}"
+            )
+            if transaction.comment:
+                transaction.comment = (
+                    transaction.comment
+                    + f"\r\nFirst payment of {servicesubscription} - added {bonus_days.days} bonus days."
+                )
+            else:
+                transaction.comment = f"First payment of {servicesubscription} - added {bonus_days.days} bonus days."
+
+            days_to_add = days_to_add + bonus_days
+            servicesubscription.paid_until = transaction.date
+
+        servicesubscription.paid_until = servicesubscription.paid_until + days_to_add
+        servicesubscription.last_payment = transaction
+        self.dirty_subscriptions[servicesubscription.id] = servicesubscription
+
+        transaction.user = servicesubscription.user
+        transaction.has_been_used = True
+        self.dirty_transactions[transaction.id] = transaction
+
+        self._log(
+            servicesubscription.user,
+            _("%(servicename)s is now paid until %(until)s due to %(transaction)s")
+            % {
+                "servicename": str(servicesubscription),
+                "until": str(servicesubscription.paid_until),
+                "transaction": str(transaction),
+            },
+        )
+
+        paid_service_id = self.graph.pays_also(servicesubscription.service_id)
+        if not paid_service_id:
+            return
+
+        paid_servicesubscriptions = [
+            ss
+            for ss in self.subscriptions_by_user[servicesubscription.user_id]
+            if ss.service_id == paid_service_id
+        ]
+        for paid_servicesubscription in paid_servicesubscriptions:
+            logger.debug(
+                f"{servicesubscription} also pays for {paid_servicesubscription}"
+            )
+            if paid_servicesubscription.state == ServiceSubscription.SUSPENDED:
+                logger.debug("Service is suspended - no action")
+                continue
+
+            # see BusinessLogic._service_paid_by_transaction for the reasoning
+            added_days = servicesubscription.paid_until - transaction.date
+            child_days = 0
+            if paid_servicesubscription.paid_until:
+                if paid_servicesubscription.paid_until > transaction.date:
+                    child_date = paid_servicesubscription.paid_until - transaction.date
+                    child_days = child_date.days
+
+            extra_days = (
+                added_days.days
+                - service.days_per_payment
+                + self.graph.services[paid_service_id].days_per_payment
+                - child_days
+            )
+            if extra_days < 0:
+                logger.debug("Gained days are negative, using previous paid to date")
+                extra_days = 0
+
+            self._service_paid_by_transaction(
+                paid_servicesubscription, transaction, extra_days
+            )
+            self._check_servicesubscription_state(paid_servicesubscription)
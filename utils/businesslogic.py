@@ -1,23 +1,47 @@
 import logging
+from collections import defaultdict
 from datetime import date, timedelta
 
-from django.db.models import QuerySet
+from django.db import connection
+from django.db.models import (
+    DateField,
+    DurationField,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    QuerySet,
+    Subquery,
+    Value,
+    prefetch_related_objects,
+)
+from django.db.models.functions import Cast
+from django.db.transaction import atomic
 from django.template.loader import render_to_string
 from django.utils import timezone, translation
 from django.utils.translation import gettext as _
 
 from drfx import config
-from mailer import send_mail
+from mailer.models import PRIORITY_MEDIUM, Message, make_message
 from users.models import (
     BankTransaction,
     CustomInvoice,
     CustomUser,
-    MemberService,
     ServiceSubscription,
+    UsersLog,
+)
+from users.servicegraph import ServiceGraph
+from users.signals import (
+    DOOR_ACCESS_DENIED,
+    DOOR_ACCESS_DENIED_NOTIFIED,
+    application_approved,
+    application_denied,
+    door_access_denied,
+    subscriptions_changed,
 )
-from users.signals import application_approved, application_denied
 
 from utils import referencenumber
+from utils.bulkreconciler import BulkReconciler
 from utils.matrixoperations import MatrixOperations
 
 logger = logging.getLogger(__name__)
@@ -39,45 +63,142 @@ class BusinessLogic:
         returns a queryset of the subscriptions that are about to expire in timerange
         defined by the service
         """
-        today = timezone.now()
-        qs = ServiceSubscription.objects.none()
-
-        # each service has different timeframe, check each one independently
-        for service in MemberService.objects.filter(
-            days_before_warning__isnull=False
-        ).all():
-            days = service.days_before_warning
-            checkdate = today + timedelta(days=days)
-            qs = qs | ServiceSubscription.objects.filter(
-                service=service,
+        today = timezone.now().date()
+
+        # each service has different timeframe, compared in the database so that
+        # all the services are checked with one query
+        warning = ExpressionWrapper(
+            F("service__days_before_warning") * Value(timedelta(days=1)),
+            output_field=DurationField(),
+        )
+        return (
+            ServiceSubscription.objects.filter(
+                service__days_before_warning__isnull=False,
                 state=ServiceSubscription.ACTIVE,
-                paid_until=checkdate.date(),
+                paid_until=Cast(Value(today) + warning, DateField()),
             )
-
-        return qs
+            .exclude(reminder_sent=today)
+            .select_related("user", "service")
+            .order_by("id")
+        )
 
     @staticmethod
     def notify_expiring_service_subscriptions(qs: QuerySet):
         """
         Send notification for service subscriptions
+
+        The mails are rendered one language at a time and queued together with
+        the user log entries. The subscriptions are marked as reminded today so
+        running this again on the same day does not send the notifications twice.
         """
-        for ss in qs:
-            subject = _("Your subscription %(service_name)s is about to expire") % {
-                "service_name": ss.service.name
-            }
-            from_email = config.NOREPLY_FROM_ADDRESS
-            to = ss.user.email
-            context = {
-                "user": ss.user,
-                "config": config,
-                "subscription": ss,
-            }
-            # note, this template will be found from users app
-            plaintext_content = render_to_string(
-                "mail/service_subscription_about_to_expire.txt", context
+        today = timezone.now().date()
+        by_language = defaultdict(list)
+        for ss in qs.select_related("user", "service"):
+            if ss.reminder_sent != today:
+                by_language[ss.user.language].append(ss)
+
+        from_email = config.NOREPLY_FROM_ADDRESS
+        messages = []
+        logs = []
+        reminded = []
+        for language, subscriptions in by_language.items():
+            with translation.override(language):
+                for ss in subscriptions:
+                    subject = _(
+                        "Your subscription %(service_name)s is about to expire"
+                    ) % {"service_name": ss.service.name}
+                    to = ss.user.email
+                    context = {
+                        "user": ss.user,
+                        "config": config,
+                        "subscription": ss,
+                    }
+                    # note, this template will be found from users app
+                    plaintext_content = render_to_string(
+                        "mail/service_subscription_about_to_expire.txt", context
+                    )
+                    messages.append(
+                        make_message(
+                            subject=subject,
+                            body=plaintext_content,
+                            from_email=from_email,
+                            to=[to],
+                            priority=PRIORITY_MEDIUM,
+                        )
+                    )
+                    logs.append(
+                        (
+                            ss.user,
+                            f"Expiry email notification sent. Subject: {subject} To: {to}",
+                        )
+                    )
+                    reminded.append(ss.id)
+
+        with atomic(), UsersLog.objects.deferred():
+            Message.objects.bulk_create(messages)
+            for user, message in logs:
+                user.log(message)
+            ServiceSubscription.objects.filter(id__in=reminded).update(
+                reminder_sent=today
             )
-            send_mail(subject, plaintext_content, from_email, [to])
-            ss.user.log(f"Expiry email notification sent. Subject: {subject} To: {to}")
+        logger.info(f"Queued {len(messages)} expiry notifications")
+
+    @staticmethod
+    def find_door_access_denials():
+        """
+        Find the door access denials the users have not been notified of
+
+        returns a queryset of the denial log entries of the last
+        DOOR_ACCESS_DENIED_NOTIFY_INTERVAL seconds that were made at least that
+        long after the user's previous notification, newest first for each user
+        """
+        interval = timedelta(seconds=config.DOOR_ACCESS_DENIED_NOTIFY_INTERVAL)
+        notified = (
+            UsersLog.objects.filter(
+                user=OuterRef("user"), message=DOOR_ACCESS_DENIED_NOTIFIED
+            )
+            .order_by("-date")
+            .values("date")[:1]
+        )
+        return (
+            UsersLog.objects.filter(
+                message__startswith=DOOR_ACCESS_DENIED.format(""),
+                date__gte=timezone.now() - interval,
+            )
+            .annotate(notified=Subquery(notified))
+            .filter(Q(notified__isnull=True) | Q(date__gte=F("notified") + interval))
+            .select_related("user")
+            .order_by("user_id", "-date")
+        )
+
+    @staticmethod
+    def notify_door_access_denied(qs: QuerySet):
+        """
+        Send the door_access_denied signal once for each user of the denials
+
+        The notifications are logged for the users, the denials in between
+        are then left out by find_door_access_denials.
+        """
+        latest = {}
+        for log in qs:
+            latest.setdefault(log.user_id, log)
+        users = [log.user for log in latest.values()]
+        prefetch_related_objects(users, "servicesubscription_set__service")
+
+        prefix = DOOR_ACCESS_DENIED.format("")
+        with UsersLog.objects.deferred():
+            for log in latest.values():
+                method = log.message.removeprefix(prefix).lower()
+                # one failing receiver does not stop the others or the other users
+                for receiver, result in door_access_denied.send_robust(
+                    sender=BusinessLogic, user=log.user, method=method
+                ):
+                    if isinstance(result, Exception):
+                        logger.error(
+                            f"Door access denied notification {receiver}: {result}"
+                        )
+                log.user.log(DOOR_ACCESS_DENIED_NOTIFIED)
+        logger.info(f"Notified {len(users)} users of denied door access")
 
     @staticmethod
     def new_transaction(transaction):
@@ -129,15 +250,165 @@ class BusinessLogic:
             )
 
     @staticmethod
-    def update_all_users():
+    def new_transactions(transactions, batch_size=None):
+        """
+        Bulk version of new_transaction for transactions that have not been saved yet
+
+        Figures out the users for all the transactions with one query per model,
+        saves the transactions with bulk_create and adds the log entries for the
+        users in bulk.
+        """
+        references = {t.reference_number for t in transactions if t.reference_number}
+
+        # same precedence as in new_transaction, subscriptions before custom invoices
+        reference_users = {}
+        for model in [CustomInvoice, ServiceSubscription]:
+            for reference_number, user_id in model.objects.filter(
+                reference_number__in=references
+            ).values_list("reference_number", "user"):
+                reference_users[reference_number] = user_id
+        users = CustomUser.objects.in_bulk(set(reference_users.values()))
+
+        with atomic(), UsersLog.objects.deferred():
+            for transaction in transactions:
+                logger.debug(f"New transaction {transaction}")
+                if transaction.reference_number in reference_users:
+                    transaction.user = users[
+                        reference_users[transaction.reference_number]
+                    ]
+                    translation.activate(transaction.user.language)
+                    transaction.user.log(
+                        _("Bank transaction of %(amount)s€ dated %(date)s")
+                        % {
+                            "amount": str(transaction.amount),
+                            "date": str(transaction.date),
+                        }
+                    )
+
+            BankTransaction.objects.bulk_create(transactions, batch_size=batch_size)
+
+    @staticmethod
+    def update_all_users(bulk=True):
         """
         Can be called from anywhere. Updates user data for all users.
+
+        By default the users are reconciled in bulk with BulkReconciler which
+        gives the same results as calling updateuser for each user but with a
+        constant number of queries. Set bulk=False to use the per user path.
         """
+        if bulk:
+            BulkReconciler().run()
+            return
+
         all_users = CustomUser.objects.all()
-        for user in all_users:
-            BusinessLogic.updateuser(user)
+        with UsersLog.objects.deferred():
+            for user in all_users:
+                BusinessLogic.updateuser(user)
+
+    @staticmethod
+    def update_users_by_reference(reference_numbers):
+        """
+        Updates only the users that have a service subscription or a custom invoice
+        with one of the given reference numbers.
+
+        Used after importing transactions so that only the users the new transactions
+        can affect get updated. The daily full update takes care of the rest.
+        """
+        reference_numbers = {ref for ref in reference_numbers if ref}
+        if not reference_numbers:
+            return
+
+        users = CustomUser.objects.filter(
+            Q(servicesubscription__reference_number__in=reference_numbers)
+            | Q(custominvoice__reference_number__in=reference_numbers)
+        ).distinct()
+        BulkReconciler(users=users).run()
+
+    @staticmethod
+    def sweep_servicesubscription_states():
+        """
+        Apply the date based state changes of _check_servicesubscription_state to
+        all service subscriptions with a few UPDATE statements
+
+        Overdue subscriptions paid past today become active, active subscriptions
+        past paid_until become overdue and subscriptions overdue for more than
+        days_until_suspending days are suspended. The expiry reminders of the
+        changed subscriptions are cleared. The changed rows are read first so
+        that the state changes can be logged for the users.
+
+        Returns the list of changed subscriptions
+        """
+        today = date.today()
+        suspend_before = Cast(
+            Value(today)
+            - ExpressionWrapper(
+                F("service__days_until_suspending") * Value(timedelta(days=1)),
+                output_field=DurationField(),
+            ),
+            DateField(),
+        )
+        transitions = [
+            (
+                ServiceSubscription.OVERDUE,
+                ServiceSubscription.ACTIVE,
+                Q(paid_until__gt=today),
+            ),
+            (
+                ServiceSubscription.ACTIVE,
+                ServiceSubscription.OVERDUE,
+                Q(paid_until__lt=today),
+            ),
+            (
+                ServiceSubscription.OVERDUE,
+                ServiceSubscription.SUSPENDED,
+                Q(service__days_until_suspending__gt=0, paid_until__lt=suspend_before),
+            ),
+        ]
+
+        # only the subscription rows are locked where the database can do that,
+        # MariaDB and MySQL lock the joined user and service rows too
+        lock = {}
+        if connection.features.has_select_for_update_of:
+            lock["of"] = ("self",)
+
+        changed = {}
+        with atomic(), UsersLog.objects.deferred():
+            for oldstate, newstate, condition in transitions:
+                qs = ServiceSubscription.objects.filter(condition, state=oldstate)
+                subscriptions = list(
+                    qs.select_related("user", "service").select_for_update(**lock)
+                )
+                if not subscriptions:
+                    continue
+                ServiceSubscription.objects.filter(
+                    id__in=[subscription.id for subscription in subscriptions]
+                ).update(state=newstate, reminder_sent=None)
+
+                for subscription in subscriptions:
+                    subscription.state = newstate
+                    subscription.reminder_sent = None
+                    changed[subscription.id] = subscription
+                    with translation.override(subscription.user.language):
+                        message = _(
+                            "Service %(servicename)s state changed from %(oldstate)s to %(newstate)s"
+                        ) % {
+                            "servicename": subscription.service.name,
+                            "oldstate": oldstate,
+                            "newstate": newstate,
+                        }
+                    subscription.user.log(message)
+                logger.info(
+                    f"{len(subscriptions)} service subscriptions changed from {oldstate} to {newstate}"
+                )
+
+        if changed:
+            subscriptions_changed.send(
+                ServiceSubscription, subscriptions=list(changed.values())
+            )
+        return list(changed.values())
 
     @staticmethod
+    @UsersLog.objects.deferred()
     def updateuser(user):
         """
         Updates the user's status based on the data in database. Can be called from outside.
@@ -159,7 +430,13 @@ class BusinessLogic:
             for transaction in transactions:
                 BusinessLogic._check_transaction_pays_custominvoice(transaction)
 
-        servicesubscriptions = ServiceSubscription.objects.filter(user=user)
+        # an earlier subscription in the loop may pay this one too, it is done
+        # to the same objects so that no stale values are saved over it
+        servicesubscriptions = list(
+            ServiceSubscription.objects.filter(user=user).select_related("service")
+        )
+        for subscription in servicesubscriptions:
+            subscription.user = user
 
         # Check subscriptions
         for subscription in servicesubscriptions:
@@ -191,6 +468,7 @@ class BusinessLogic:
         # Move user's subscriptions to overdue state
         for subscription in ServiceSubscription.objects.filter(user=user):
             subscription.state = ServiceSubscription.OVERDUE
+            subscription.reminder_sent = None
             subscription.save()
             BusinessLogic._servicesubscription_state_changed(
                 subscription, ServiceSubscription.SUSPENDED, subscription.state
@@ -231,6 +509,7 @@ class BusinessLogic:
             return
 
         oldstate = subscription.state
+        service = ServiceGraph.get().services[subscription.service_id]
 
         # Check if the service has been overdue and can be activated
         if (
@@ -239,6 +518,7 @@ class BusinessLogic:
             and subscription.paid_until > date.today()
         ):
             subscription.state = ServiceSubscription.ACTIVE
+            subscription.reminder_sent = None
             subscription.save()
             BusinessLogic._servicesubscription_state_changed(
                 subscription, oldstate, subscription.state
@@ -252,19 +532,21 @@ class BusinessLogic:
         ):
             logger.debug(f"{subscription} payment overdue so changing state to OVERDUE")
             subscription.state = ServiceSubscription.OVERDUE
+            subscription.reminder_sent = None
             subscription.save()
             BusinessLogic._servicesubscription_state_changed(
                 subscription, oldstate, subscription.state
             )
         if (
             subscription.state == ServiceSubscription.OVERDUE
-            and subscription.service.days_until_suspending
-            and subscription.days_overdue() > subscription.service.days_until_suspending
+            and service.days_until_suspending
+            and subscription.days_overdue() > service.days_until_suspending
         ):
             logger.debug(
                 f"{subscription} has been overdue for {subscription.days_overdue()} days - suspending"
             )
             subscription.state = ServiceSubscription.SUSPENDED
+            subscription.reminder_sent = None
             subscription.save()
             BusinessLogic._servicesubscription_state_changed(
                 subscription, oldstate, subscription.state
@@ -331,15 +613,15 @@ class BusinessLogic:
             return
 
         # Figure out other services that pay for this service
-        services_that_pay_this = MemberService.objects.filter(
-            pays_also_service=subscription.service
-        )
-        for service in services_that_pay_this:
+        graph = ServiceGraph.get()
+        for service_id in graph.paid_by(subscription.service_id):
+            service = graph.services[service_id]
             if BusinessLogic._user_is_subscribed_to(servicesubscriptions, service):
                 logger.debug(
-                    f"Service is paid by {service} which user is subscribed so skipping this service."
+                    f"Service is paid by {service.name} which user is subscribed so skipping this service."
                 )
                 return
+        service = graph.services[subscription.service_id]
 
         # Check generic transactions that could pay for this service
         transactions = BankTransaction.objects.filter(
@@ -347,14 +629,15 @@ class BusinessLogic:
         ).order_by("date")
 
         for transaction in transactions:
-            if BusinessLogic._transaction_pays_service(
-                transaction, subscription.service
-            ):
+            if BusinessLogic._transaction_pays_service(transaction, service):
                 logger.debug(
                     f"Transaction is new and pays for service {subscription.service}"
                 )
                 BusinessLogic._service_paid_by_transaction(
-                    subscription, transaction, subscription.service.days_per_payment
+                    subscription,
+                    transaction,
+                    service.days_per_payment,
+                    servicesubscriptions,
                 )
             else:
                 transaction.user = subscription.user
@@ -367,7 +650,7 @@ class BusinessLogic:
     @staticmethod
     def _transaction_pays_service(transaction, service):
         """
-        Checks if given transaction pays the service. Returns boolean.
+        Checks if given transaction pays the service (a ServiceGraph node). Returns boolean.
         """
         if service.cost_min and transaction.amount < service.cost_min:
             return False
@@ -381,16 +664,23 @@ class BusinessLogic:
         Returns True if user (whose servicesubscriptions is given) is subscribed to given service
         """
         for subscription in servicesubscriptions:
-            if subscription.service == service:
+            if subscription.service_id == service.id:
                 return True
         return False
 
     @staticmethod
-    def _service_paid_by_transaction(servicesubscription, transaction, add_days):
+    def _service_paid_by_transaction(
+        servicesubscription, transaction, add_days, servicesubscriptions=None
+    ):
         """
         Called if transaction actually pays for extra time on given service subscription
+
+        servicesubscriptions are the user's subscriptions already in memory, the
+        subscriptions this one also pays for are taken from them when given
         """
         translation.activate(servicesubscription.user.language)
+        graph = ServiceGraph.get()
+        service = graph.services[servicesubscription.service_id]
 
         logger.debug(f"Paying {servicesubscription} and gained {add_days} days more")
 
@@ -398,9 +688,7 @@ class BusinessLogic:
         days_to_add = timedelta(days=add_days)
         # First payment - initialize with payment date and add first time bonus days
         if not servicesubscription.paid_until:
-            bonus_days = timedelta(
-                days=servicesubscription.service.days_bonus_for_first
-            )
+            bonus_days = timedelta(days=service.days_bonus_for_first)
             logger.debug(
                 f"{servicesubscription} paid for first time, adding bonus of {bonus_days}"
             )
@@ -437,12 +725,21 @@ class BusinessLogic:
         )
 
         # Handle case where this service also pays for another service
-        if servicesubscription.service.pays_also_service:
+        paid_service_id = graph.pays_also(servicesubscription.service_id)
+        if paid_service_id:
             # All subscription for current user paid by this service
-            paid_servicesubscriptions = ServiceSubscription.objects.filter(
-                user=servicesubscription.user,
-                service=servicesubscription.service.pays_also_service,
-            )
+            if servicesubscriptions is None:
+                paid_servicesubscriptions = ServiceSubscription.objects.filter(
+                    user=servicesubscription.user,
+                    service_id=paid_service_id,
+                ).select_related("service")
+            else:
+                paid_servicesubscriptions = [
+                    ss
+                    for ss in servicesubscriptions
+                    if ss.service_id == paid_service_id
+                ]
+            paid_service = graph.services[paid_service_id]
             for paid_servicesubscription in paid_servicesubscriptions:
                 logger.debug(
                     f"{servicesubscription} also pays for {paid_servicesubscription}"
@@ -470,15 +767,15 @@ class BusinessLogic:
 
                     extra_days = (
                         added_days.days
-                        - servicesubscription.service.days_per_payment
-                        + paid_servicesubscription.service.days_per_payment
+                        - service.days_per_payment
+                        + paid_service.days_per_payment
                         - child_days
                     )
 
                     logger.debug(f"""Child process add days calculated by
                               {added_days.days}
-                            - {servicesubscription.service.days_per_payment}
-                            + {paid_servicesubscription.service.days_per_payment}
+                            - {service.days_per_payment}
+                            + {paid_service.days_per_payment}
                             - {child_days}
                             = gained {extra_days} days more""")
 
@@ -491,7 +788,10 @@ class BusinessLogic:
                         extra_days = 0
 
                     BusinessLogic._service_paid_by_transaction(
-                        paid_servicesubscription, transaction, extra_days
+                        paid_servicesubscription,
+                        transaction,
+                        extra_days,
+                        servicesubscriptions,
                     )
 
                     BusinessLogic._check_servicesubscription_state(
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import codecs
 import logging
 import datetime
 import re
 from decimal import Decimal
+from itertools import islice
 
+from django.core.exceptions import ValidationError
+from django.db.transaction import atomic
+
+from drfx import config
 from users.models import BankTransaction
 
 from utils.businesslogic import BusinessLogic
@@ -28,8 +34,9 @@ This class contains data importers
    some kind of standard.
    Use it if you can or write your own importer.
 
-After data is imported, businesslogic to update all user data is
-invoked. All functions return an object showing counts of imported,
+After data is imported, businesslogic is invoked to update the users
+that the new transactions reference. Pass full_update=True to update
+all users instead. All functions return an object showing counts of imported,
 already existing and failed items and array of failed rows. These
 are displayed in the import UI.
 """
@@ -40,12 +47,25 @@ class DataImport:
     # Note: this is the text-based TITO, not XML.
     # DEPRECATED: but the decorator is only available after python 3.13
     @staticmethod
-    def import_tito(f):
-        tito = f.read().decode("utf8")
-        lines = tito.split("\n")
-        imported = exists = error = 0
+    def import_tito(f, full_update=False):
         failedrows = []
-        for line in lines[1:]:
+        return DataImport._import_rows(
+            DataImport._parse_tito(f, failedrows), failedrows, full_update
+        )
+
+    @staticmethod
+    def _parse_tito(f, failedrows):
+        """
+        Generator for the transactions in a TITO file
+
+        Reads the file one line at a time so the whole file is never in memory.
+        Yields dicts of BankTransaction fields and adds the lines that could not
+        be parsed to failedrows.
+        """
+        lines = DataImport._read_lines(f)
+        # skip the header
+        next(lines, None)
+        for line in lines:
             logger.debug(f"import_tito - Processing line: {line}")
             try:
                 if len(line) == 0 or line[0] != "T":
@@ -73,7 +93,7 @@ class DataImport:
                     message = line[52:87].strip()
                     if message == "Viitemaksu":
                         message = None
-                    amount = int(line[87:106]) / 100
+                    amount = Decimal(int(line[87:106])) / 100
                     peer = line[108:143]
                     peer = peer.replace("[", "Ä")
                     peer = peer.replace("]", "Å")
@@ -81,53 +101,49 @@ class DataImport:
                     # tito format has leading zeroes in reference number, strip them
                     reference = line[159:179].strip().lstrip("0")
 
-                    # Done parsing, add the transaction
-
-                    try:
-                        # Archival reference with date is unique
-                        BankTransaction.objects.get(
-                            archival_reference=archival_reference
-                            # reverted for now. the dates can differ when fething data from nordigen
-                            # , date=transaction_date
-                        )
-                        exists = exists + 1
-                    except BankTransaction.DoesNotExist:
-                        transaction = BankTransaction.objects.create(
-                            archival_reference=archival_reference,
-                            date=transaction_date,
-                            amount=amount,
-                            reference_number=reference,
-                            sender=peer,
-                            transaction_id=transaction_id,
-                            code=code,
-                        )
-                        BusinessLogic.new_transaction(transaction)
-                        imported = imported + 1
+                    yield dict(
+                        archival_reference=archival_reference,
+                        date=transaction_date,
+                        amount=amount,
+                        reference_number=reference,
+                        sender=peer,
+                        transaction_id=transaction_id,
+                        code=code,
+                    )
             except ParseError as err:
                 logger.error(f"Error parsing data: {err}")
-                error = error + 1
                 failedrows.append(line + " (" + str(err) + ")")
 
-        results = {
-            "imported": imported,
-            "exists": exists,
-            "error": error,
-            "failedrows": failedrows,
-        }
-        logger.info(f"Data imported: {results} - now updating all users..")
-
-        BusinessLogic.update_all_users()
+    @staticmethod
+    def _read_lines(f, chunk_size=64 * 1024):
+        """
+        Generator for the lines of an utf8 file, split on "\\n" like str.split
 
-        return results
+        Reads and decodes the file chunk by chunk.
+        """
+        decoder = codecs.getincrementaldecoder("utf8")()
+        pending = ""
+        while chunk := f.read(chunk_size):
+            pending += decoder.decode(chunk)
+            *lines, pending = pending.split("\n")
+            yield from lines
+        yield pending + decoder.decode(b"", final=True)
 
     # Holvi TITO import. TITO spec here: ???
     # Note: this is the XLSX-based TITO.
     @staticmethod
-    def import_holvi(f):
-        holvi = HolviToolbox.parse_account_statement(f)
-        imported = exists = error = 0
+    def import_holvi(f, full_update=False):
         failedrows = []
-        for line in holvi:
+        return DataImport._import_rows(
+            DataImport._parse_holvi(f, failedrows), failedrows, full_update
+        )
+
+    @staticmethod
+    def _parse_holvi(f, failedrows):
+        """
+        Generator for the transactions in a Holvi account statement, see _parse_tito
+        """
+        for line in HolviToolbox.parse_account_statement(f):
             logger.debug(f"import_holvi - Processing line: {line}")
             try:
                 if len(line) == 0:
@@ -141,58 +157,31 @@ class DataImport:
                 message = line["Message"].strip()
                 if message in ["Viitemaksu", "None"]:
                     message = None
-                amount = Decimal(line["Amount"])
+                amount = Decimal(line["Amount"]).quantize(Decimal("0.01"))
                 peer = line["Counterparty"]
                 # holvi reference has leading zeroes, clean them up here also
                 reference = line["Reference"].strip().lstrip("0")
 
-                # Done parsing, add the transaction
-
-                try:
-                    # Archival reference with date is unique
-                    BankTransaction.objects.get(
-                        archival_reference=archival_reference
-                        # reverted for now. the dates can differ when fething data from nordigen
-                        # , date=transaction_date
-                    )
-                    exists = exists + 1
-                except BankTransaction.DoesNotExist:
-                    transaction = BankTransaction.objects.create(
-                        archival_reference=archival_reference,
-                        date=transaction_date,
-                        amount=amount,
-                        reference_number=reference,
-                        sender=peer,
-                    )
-                    BusinessLogic.new_transaction(transaction)
-                    imported = imported + 1
+                yield dict(
+                    archival_reference=archival_reference,
+                    date=transaction_date,
+                    amount=amount,
+                    reference_number=reference,
+                    sender=peer,
+                )
             except ParseError as err:
                 logger.error(f"Error parsing data: {err}")
-                error = error + 1
                 failedrows.append(line + " (" + str(err) + ")")
 
-        results = {
-            "imported": imported,
-            "exists": exists,
-            "error": error,
-            "failedrows": failedrows,
-        }
-        logger.info(f"Data imported: {results} - now updating all users..")
-
-        BusinessLogic.update_all_users()
-
-        return results
-
     @staticmethod
-    def import_nordigen(data):
+    def import_nordigen(data, full_update=False):
         """
         Importer for nordigen api response https://ob.nordigen.com/api/docs#/accounts/accounts_transactions_retrieve
 
         Takes the whole nordigen response but parses only the "booked" section from it (pending transactions do not count)
         """
         booked = data["transactions"]["booked"]
-        imported = exists = error = 0
-
+        rows = []
         failedrows = []
         for one in booked:
             logger.debug(f"import_nordigen - Processing entry: {one}")
@@ -221,16 +210,8 @@ class DataImport:
                         reference = match.group(1)
                         message = message + " (reference extracted from message)"
 
-                try:
-                    # Archival reference with date is unique
-                    BankTransaction.objects.get(
-                        archival_reference=archival_reference
-                        # reverted for now. the dates can differ when fething data from nordigen
-                        # , date=transaction_date
-                    )
-                    exists = exists + 1
-                except BankTransaction.DoesNotExist:
-                    transaction = BankTransaction.objects.create(
+                rows.append(
+                    dict(
                         archival_reference=archival_reference,
                         date=transaction_date,
                         transaction_id=archival_reference,
@@ -239,22 +220,81 @@ class DataImport:
                         sender=sender,
                         message=message,
                     )
-                    BusinessLogic.new_transaction(transaction)
-                    imported = imported + 1
+                )
 
             except Exception as e:
                 logger.error(f"Error: {e}")
-                error = error + 1
                 failedrows.append(str(one) + " (" + str(e) + ")")
 
+        return DataImport._import_rows(rows, failedrows, full_update)
+
+    @staticmethod
+    def _import_rows(rows, failedrows, full_update):
+        """
+        Add the parsed transactions that do not exist yet and update the users
+
+        rows is an iterable of dicts of BankTransaction fields, it is consumed
+        lazily so it can be a generator. The rows are handled in batches of
+        IMPORT_BATCH_SIZE: existing archival references are looked up with one
+        query per batch and the new transactions are inserted with bulk_create,
+        all inside one database transaction. Each row is validated before it is
+        added to the batch so that one invalid row ends up in failedrows instead
+        of failing the whole import.
+        """
+        imported = exists = 0
+        references = set()
+        batch_size = config.IMPORT_BATCH_SIZE
+        rows = iter(rows)
+        with atomic():
+            while batch := list(islice(rows, batch_size)):
+                # Archival reference is unique, not with date as the dates can differ
+                # when fething data from nordigen
+                existing = set(
+                    BankTransaction.objects.filter(
+                        archival_reference__in={
+                            row["archival_reference"] for row in batch
+                        }
+                    ).values_list("archival_reference", flat=True)
+                )
+                transactions = []
+                for row in batch:
+                    if row["archival_reference"] in existing:
+                        exists = exists + 1
+                        continue
+                    transaction = BankTransaction(**row)
+                    try:
+                        transaction.full_clean(
+                            validate_unique=False, validate_constraints=False
+                        )
+                    except ValidationError as e:
+                        logger.error(f"Error: {e}")
+                        failedrows.append(str(row) + " (" + str(e) + ")")
+                        continue
+                    transactions.append(transaction)
+                    # same archival reference can be in the data more than once
+                    existing.add(row["archival_reference"])
+                    references.add(row["reference_number"])
+                    imported = imported + 1
+                BusinessLogic.new_transactions(transactions, batch_size)
+
         results = {
             "imported": imported,
             "exists": exists,
-            "error": error,
+            "error": len(failedrows),
             "failedrows": failedrows,
         }
+        logger.info(f"Data imported: {results} - now updating users..")
 
-        logger.info(f"Data imported: {results} - now updating all users..")
-        BusinessLogic.update_all_users()
+        DataImport._update_users(references, full_update)
 
         return results
+
+    @staticmethod
+    def _update_users(references, full_update):
+        """
+        Update the users affected by the imported transactions, or everyone
+        """
+        if full_update:
+            BusinessLogic.update_all_users()
+        else:
+            BusinessLogic.update_users_by_reference(references)
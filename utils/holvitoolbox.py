@@ -1,4 +1,4 @@
-from io import BytesIO
+from datetime import date, datetime, time
 import re
 
 from django.core.files.uploadedfile import InMemoryUploadedFile
@@ -7,6 +7,43 @@ from openpyxl import load_workbook
 import dateparser
 
 
+class HolviDateParser:
+    """
+    Parses the date cells of one Holvi account statement
+
+    dateparser is slow as it detects the language for every value, so the known Holvi
+    formats are tried first and the format that worked is tried first for the next rows.
+    Values that do not match any of the formats are given to dateparser.
+    """
+
+    FORMATS = ["%d %b %Y", "%d %B %Y", "%Y-%m-%d"]
+
+    def __init__(self):
+        self.formats = list(self.FORMATS)
+
+    def parse(self, value):
+        # openpyxl returns real date cells as datetimes already
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, date):
+            return datetime.combine(value, time())
+        if not isinstance(value, str):
+            return dateparser.parse(value)
+
+        # Holvi abbreviates September as "Sept" which strptime does not know
+        text = re.sub(r"\bSept\b", "Sep", value.strip())
+        for date_format in self.formats:
+            try:
+                parsed = datetime.strptime(text, date_format)
+            except ValueError:
+                continue
+            if date_format != self.formats[0]:
+                self.formats.remove(date_format)
+                self.formats.insert(0, date_format)
+            return parsed
+        return dateparser.parse(value)
+
+
 class HolviToolbox:
     """
     Contains various helper methods to handle Holvi data
@@ -22,15 +59,31 @@ class HolviToolbox:
         Expected fields:
         "Value date", "Booking date", "Amount", "Currency", "Counterparty", "Description", "Reference",
         "Message", "Filing ID"
+
+        This is a generator. The file is read with openpyxl read only mode straight from the
+        uploaded file and the rows are yielded one by one, so the whole sheet is never in memory.
         """
-        sheet = load_workbook(filename=BytesIO(uploaded_file.read())).active
+        workbook = load_workbook(filename=uploaded_file, read_only=True)
+        try:
+            yield from HolviToolbox._parse_sheet(workbook.active, uploaded_file.name)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def _parse_sheet(sheet, source_file):
+        # read only mode trusts the dimensions written in the file and those can be wrong
+        sheet.reset_dimensions()
 
         date_fields = ["Value date", "Payment date", "Date"]
+        date_parser = HolviDateParser()
         date_found = False
         date_error = None
         headers = []
-        items = []
         for row_index, row in enumerate(sheet.values):
+            # read only mode gives empty rows as empty tuples
+            if all(cell is None for cell in row):
+                continue
+
             # Skip summary rows
             if headers == [] and row[0] not in date_fields:
                 continue
@@ -39,13 +92,15 @@ class HolviToolbox:
                 # Collect header row
                 headers = list(row)
             else:
-                # Extract row data as dictionary with header row as keys
-                item = dict(zip(headers, list(row)))
+                # Extract row data as dictionary with header row as keys, read only mode
+                # leaves out the empty cells at the end of the row
+                row = list(row) + [None] * (len(headers) - len(row))
+                item = dict(zip(headers, row))
 
                 # Parse payment date
                 for field_name in date_fields:
                     try:
-                        item["Date_parsed"] = dateparser.parse(item[field_name])
+                        item["Date_parsed"] = date_parser.parse(item[field_name])
                         date_found = True
                         break
                     except KeyError as exc:
@@ -68,9 +123,7 @@ class HolviToolbox:
                 item["Message"] = str(item["Message"])
 
                 # Add meta fields
-                item["source_file"] = uploaded_file.name
+                item["source_file"] = source_file
                 item["source_row"] = str(row_index + 1)
 
-                items.append(item)
-
-        return items
+                yield item
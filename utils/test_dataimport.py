@@ -1,16 +1,26 @@
+import glob
 import io
 import json
-from datetime import date, timedelta
+import os
+import time
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 import unittest
+from unittest import mock
+
+import dateparser
+from openpyxl import Workbook, load_workbook
 
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from .dataimport import DataImport
+from .holvitoolbox import HolviDateParser, HolviToolbox
 from users import models
 
 
@@ -89,6 +99,15 @@ class TestServiceSubscriptionContinuationWithImport(TestCase):
         )
         paid_delta += 30
 
+        # transaction got mapped to the user
+        transaction = models.BankTransaction.objects.get()
+        self.assertEqual(transaction.user, self.user)
+        self.assertTrue(
+            models.UsersLog.objects.filter(
+                user=self.user, message__startswith="Bank transaction of 10"
+            ).exists()
+        )
+
         self.servicesubscription.refresh_from_db()
         self.assertEqual(
             self.servicesubscription.state, models.ServiceSubscription.OVERDUE
@@ -124,6 +143,59 @@ class TestServiceSubscriptionContinuationWithImport(TestCase):
         models.BankTransaction.objects.all().delete()
 
 
+class TestImportUpdatesAffectedUsers(TestServiceSubscriptionContinuationWithImport):
+    def setUp(self):
+        super().setUp()
+        # another user whose subscription has run out but who pays nothing
+        self.other_user = get_user_model().objects.create_customuser(
+            first_name="Other",
+            last_name="LastName",
+            email="user2@example.com",
+            birthday=timezone.now(),
+            municipality="City",
+            nick="user2",
+            phone="+358123124",
+        )
+        self.other_subscription = models.ServiceSubscription.objects.create(
+            user=self.other_user,
+            service=self.memberservice,
+            state=models.ServiceSubscription.ACTIVE,
+            paid_until=timezone.now().date() + timedelta(days=-1),
+            reference_number="22224",
+        )
+
+    def _import(self, full_update=False):
+        data = self._createTitodata(timezone.now().date() + timedelta(days=-1), 10)
+        lines = io.BytesIO(b"header\n" + "".join(data.values()).encode())
+        return DataImport.import_tito(lines, full_update)
+
+    def test_only_affected_users_updated(self):
+        results = self._import()
+        self.assertEqual(results["imported"], 1)
+
+        self.servicesubscription.refresh_from_db()
+        self.assertEqual(
+            self.servicesubscription.paid_until,
+            timezone.now().date() + timedelta(days=-20),
+        )
+        # left for the daily full update
+        self.other_subscription.refresh_from_db()
+        self.assertEqual(
+            self.other_subscription.state, models.ServiceSubscription.ACTIVE
+        )
+
+    def test_full_update(self):
+        self._import(full_update=True)
+        self.other_subscription.refresh_from_db()
+        self.assertEqual(
+            self.other_subscription.state, models.ServiceSubscription.OVERDUE
+        )
+
+    def tearDown(self):
+        super().tearDown()
+        self.other_user.delete()
+
+
 class TestTitoImporter(TestCase):
     def _getbasetitodata(self):
         """
@@ -237,6 +309,67 @@ class TestTitoImporter(TestCase):
             results, {"imported": 0, "exists": 1, "error": 0, "failedrows": []}
         )
 
+    def test_tito_import_existing_in_one_query(self):
+        """
+        existing archival references are looked up with one query, not per row
+        """
+        models.BankTransaction.objects.all().delete()
+        lines = []
+        for i in range(5):
+            data = self._getbasetitodata()
+            data["arkistointitunnus"] = f"ABC{i}".rjust(18, "0")
+            lines.append("".join(data.values()))
+        # and one duplicate inside the same file
+        lines.append(lines[0])
+        tito = ("header\n" + "\n".join(lines)).encode()
+
+        results = DataImport.import_tito(io.BytesIO(tito))
+        self.assertDictEqual(
+            results, {"imported": 5, "exists": 1, "error": 0, "failedrows": []}
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            results = DataImport.import_tito(io.BytesIO(tito))
+        self.assertDictEqual(
+            results, {"imported": 0, "exists": 6, "error": 0, "failedrows": []}
+        )
+        selects = [q for q in queries if q["sql"].startswith("SELECT")]
+        self.assertEqual(len(selects), 1)
+
+    def test_tito_read_lines(self):
+        """
+        lines are decoded incrementally, also when a chunk splits a character
+        """
+        text = "header\r\nÄÅÖ line\n\nlast"
+        for chunk_size in [1, 2, 3, 1024]:
+            lines = DataImport._read_lines(io.BytesIO(text.encode()), chunk_size)
+            self.assertEqual(list(lines), text.split("\n"))
+
+    def test_tito_import_is_streamed(self):
+        """
+        the file is read in chunks and not all at once
+        """
+
+        class ChunkedFile(io.BytesIO):
+            def read(self, size=-1):
+                assert size > 0, "whole file read"
+                return super().read(size)
+
+        models.BankTransaction.objects.all().delete()
+        data = self._getbasetitodata()
+        tito = b"header\n" + "".join(data.values()).encode() + b"\n"
+        results = DataImport.import_tito(ChunkedFile(tito))
+        # the last empty line is an error just like before
+        self.assertDictEqual(
+            results,
+            {
+                "imported": 1,
+                "exists": 0,
+                "error": 1,
+                "failedrows": [" (Empty line or not starting with T)"],
+            },
+        )
+
     def test_tito_cents(self):
         models.BankTransaction.objects.all().delete()
         data = self._getbasetitodata()
@@ -388,10 +521,92 @@ class TestHolviImporter(TestCase):
         )
         self.assertEqual(transaction.amount, Decimal("-7.44"), "Check decimals")
 
+    def test_holvi_parse_is_streamed(self):
+        """
+        Statement rows are yielded one by one and the empty rows are skipped
+        """
+        xls = open("utils/holvi-account-test-statement-2022-10.xlsx", "rb")
+        upload = SimpleUploadedFile(xls.name, xls.read())
+        rows = HolviToolbox.parse_account_statement(upload)
+        first = next(rows)
+        self.assertEqual(first["source_row"], "9")
+        self.assertEqual(len(list(rows)), 10)
+
     def tearDown(self):
         models.BankTransaction.objects.all().delete()
 
 
+class TestHolviDateParser(TestCase):
+    def test_known_formats(self):
+        parser = HolviDateParser()
+        self.assertEqual(parser.parse("30 Mar 2022"), datetime(2022, 3, 30))
+        self.assertEqual(parser.parse("1 Sept 2022"), datetime(2022, 9, 1))
+        self.assertEqual(parser.parse("2 September 2022"), datetime(2022, 9, 2))
+        self.assertEqual(parser.parse("2022-01-05"), datetime(2022, 1, 5))
+        # the format that worked last is tried first
+        self.assertEqual(parser.formats[0], "%Y-%m-%d")
+
+    def test_date_cells(self):
+        parser = HolviDateParser()
+        self.assertEqual(parser.parse(date(2022, 3, 30)), datetime(2022, 3, 30))
+        self.assertEqual(
+            parser.parse(datetime(2022, 3, 30, 12, 0)), datetime(2022, 3, 30, 12, 0)
+        )
+
+    def test_fallback_to_dateparser(self):
+        self.assertEqual(
+            HolviDateParser().parse("March 30th, 2022"), datetime(2022, 3, 30)
+        )
+
+
+@unittest.skipUnless(
+    os.environ.get("BENCHMARK"), "Benchmarks are run with BENCHMARK=1 in environment"
+)
+class BenchmarkHolviParsing(TestCase):
+    """
+    Rows per second when parsing the test statements scaled up, with the Holvi
+    date formats and with dateparser only
+    """
+
+    ROWS = 5000
+
+    def _scaled_statement(self, filename):
+        source = load_workbook(filename, read_only=True).active
+        workbook = Workbook()
+        sheet = workbook.active
+        header, rows = None, []
+        for row in source.values:
+            if header is None and row and row[0] in ["Value date", "Payment date"]:
+                header = row
+            elif header is not None and any(cell is not None for cell in row):
+                rows.append(row)
+        sheet.append(header)
+        for index in range(self.ROWS):
+            sheet.append(rows[index % len(rows)])
+        data = io.BytesIO()
+        workbook.save(data)
+        return SimpleUploadedFile(filename, data.getvalue())
+
+    def _rows_per_second(self, upload):
+        upload.seek(0)
+        start = time.perf_counter()
+        count = sum(1 for _ in HolviToolbox.parse_account_statement(upload))
+        return count / (time.perf_counter() - start)
+
+    def test_parse_account_statement(self):
+        for filename in sorted(glob.glob("utils/holvi-account-test-statement-*.xlsx")):
+            upload = self._scaled_statement(filename)
+            with mock.patch.object(
+                HolviDateParser, "parse", lambda self, value: dateparser.parse(value)
+            ):
+                before = self._rows_per_second(upload)
+            after = self._rows_per_second(upload)
+            print(
+                f"\n{filename} {self.ROWS} rows: dateparser {before:.0f} rows/s, "
+                f"holvi formats {after:.0f} rows/s"
+            )
+
+
 class TestNordigenmporter(TestCase):
     def test_nordigen(self):
         """
@@ -426,6 +641,49 @@ class TestNordigenmporter(TestCase):
             self.assertEqual(test5.amount, Decimal("80.00"))
             self.assertEqual(test5.reference_number, "123")
 
+    @override_settings(IMPORT_BATCH_SIZE=3)
+    def test_nordigen_invalid_row(self):
+        """
+        One invalid row is reported and the others in the same batch are imported
+        """
+
+        def entry(transaction_id, amount, name="TESTER"):
+            return {
+                "transactionId": transaction_id,
+                "valueDate": "2022-10-23",
+                "transactionAmount": {"amount": amount, "currency": "EUR"},
+                "entryReference": "123",
+                "debtorName": name,
+                "additionalInformation": "Viitemaksu",
+            }
+
+        data = {
+            "transactions": {
+                "booked": [
+                    entry("VALID1", "10.00"),
+                    entry("BADAMOUNT", "ten"),
+                    entry("VALID2", "20.00"),
+                    entry("LONGNAME", "30.00", name="X" * 513),
+                    entry("VALID3", "40.00"),
+                ]
+            }
+        }
+        res = DataImport.import_nordigen(data)
+
+        self.assertEqual(res["imported"], 3)
+        self.assertEqual(res["exists"], 0)
+        self.assertEqual(res["error"], 2)
+        self.assertIn("BADAMOUNT", res["failedrows"][0])
+        self.assertIn("amount", res["failedrows"][0])
+        self.assertIn("LONGNAME", res["failedrows"][1])
+        self.assertIn("sender", res["failedrows"][1])
+        self.assertQuerySetEqual(
+            models.BankTransaction.objects.order_by("archival_reference").values_list(
+                "archival_reference", flat=True
+            ),
+            ["VALID1", "VALID2", "VALID3"],
+        )
+
     def tearDown(self):
         models.BankTransaction.objects.all().delete()
 
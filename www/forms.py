@@ -80,6 +80,11 @@ class FileImportForm(forms.Form):
         ],
     )
     file = forms.FileField()
+    full_update = forms.BooleanField(
+        label="Update all users after import",
+        help_text="By default only the users that the imported transactions reference are updated",
+        required=False,
+    )
 
 
 class CustomInvoiceServiceChoiceField(forms.ModelChoiceField):
@@ -27,6 +27,7 @@ from users.models import (
     ServiceSubscription,
     UsersLog,
 )
+from users.servicegraph import ServiceGraph
 from utils import referencenumber
 from utils.businesslogic import BusinessLogic
 from utils.dataexport import DataExport
@@ -61,16 +62,18 @@ def register(request):
 
             # extra handling for services that pay for other services
             # TODO: this logic should probably live in business logic
-            memberservices = MemberService.objects.all()
+            memberservices = MemberService.objects.in_bulk()
+            graph = ServiceGraph.get()
             subscribed_services = []
 
             print(servicesform.cleaned_data.get("services"))
 
-            for service in memberservices:
+            for service in memberservices.values():
                 if str(service.id) in servicesform.cleaned_data.get("services", []):
                     subscribed_services.append(service)
-                    if service.pays_also_service:
-                        subscribed_services.append(service.pays_also_service)
+                    paid_service_id = graph.pays_also(service.id)
+                    if paid_service_id in memberservices:
+                        subscribed_services.append(memberservices[paid_service_id])
 
             # Convert to set for unique items
             subscribed_services = set(subscribed_services)
@@ -114,10 +117,11 @@ def dataimport(request):
         form = FileImportForm(request.POST, request.FILES)
         if form.is_valid():
             dataimport = DataImport()
+            full_update = form.cleaned_data["full_update"]
             if request.POST["filetype"] == "TITO":
-                report = dataimport.import_tito(request.FILES["file"])
+                report = dataimport.import_tito(request.FILES["file"], full_update)
             if request.POST["filetype"] == "HOLVI":
-                report = dataimport.import_holvi(request.FILES["file"])
+                report = dataimport.import_holvi(request.FILES["file"], full_update)
     else:
         form = FileImportForm()
     return render(request, "www/import.html", {"form": form, "report": report})